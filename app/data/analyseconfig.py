@@ -30,6 +30,12 @@ sys.path.append(run_dir)
 app_dir = os.path.dirname(os.path.abspath(__file__))
 """The application dir (where this script is also living)."""
 
+newdetect_dir = os.path.join(app_dir, 'newdetect')
+"""Dir of the newdetect module used for spot detection."""
+
+sys.path.append(newdetect_dir)
+"""We add that to the path so newdetect can be imported as a module."""
+
 #################################################################
 
 # Add the path for python modules installed locally
@@ -68,3 +74,34 @@ spot_timing = [-1, -1, -1, nitrate_timing[nitrate_model], phosphate_timing[phosp
 
 average_times = [-1, 0, 1]
 """Capture times relative to spot timing to take averages over."""
+
+mask_drift_limit = 4.0
+"""Pixels the cartridge may move between spot captures before the circles
+are detected again instead of reusing the ones found in the first capture.
+Set to None to always detect the circles in every capture."""
+
+store_spot_cutouts = os.environ.get("STORE_SPOT_CUTOUTS", "0") == "1"
+"""Store PNG cutouts of the spots of every analysed image for debugging.
+Off by default to save time and SD card wear. Enabled by setting the
+STORE_SPOT_CUTOUTS device variable to 1."""
+
+stream_window = None
+"""Seconds around each of the average_times to average all frames from the
+camera video port over. The video port is only streaming around the
+captures. Set to None to capture a single still image at each time."""
+
+use_roi = False
+"""Only capture and process the region of interest of the camera frame
+holding the cartridge. The region is found from the circles detected in the
+first check and recalibrated after every check with a good enough template
+match score. The stored and uploaded sample images are then of the region
+only."""
+
+roi_min_score = 0.18
+"""Lowest template match score of the circles to calibrate the region of
+interest from. Good cartridges score about 0.23 to 0.33, an empty frame or
+a cartridge moved out of the region below 0.13. A lower score inside the
+region fails the check, and the next check uses the whole frame again."""
+
+roi_file = data_dir + "/camera_roi.json"
+"""File with the region of interest calibrated for this device."""
@@ -4,8 +4,10 @@
 __copyright__ = "Copyright (C) 2020 Nordetect"
 
 import uuid
+import hashlib
+import threading
 
-from typing import Dict,  Optional, Any
+from typing import Dict,  Optional, Any, Iterator
 from flask import Flask, send_from_directory, Response, request
 from flask_cors import CORS
 import os
@@ -24,6 +26,9 @@ import user_options
 import checksample_com as cs_com       ## NMR comment out in minimal
 import utils
 import barscan
+import tracing
+import resultsindex
+import uploadqueue
 if config.enabled_wifi:
     import NetworkManager
 try:
@@ -57,6 +62,10 @@ if not os.path.exists(config.debug_dir):
 utils.backend_logger(f'*****Starting Flask')
 
 stored_results_directory = config.stored_results_dir
+results_index = resultsindex.ResultsIndex(config.results_index_file)
+upload_queue = uploadqueue.UploadQueue(config.upload_queue_file)
+# uploads by the user and by the upload queue are done one at a time
+upload_lock = threading.Lock()
 results_directory = config.results_dir
 stored_images_directory = config.stored_images_dir
 results_file = os.path.join(results_directory, config.results_filename)
@@ -251,70 +260,182 @@ def get_state_info() -> Response:
         #return Response("Error returning state values", 422)
 
 def read_stored_results(want_upload_status, active_account_only):
-    results = []
+    # the stored results are looked up in the index instead of reading every file
+    if active_account_only:
+        account_id = get_json_from_file(active_account_file).get('id', '')
+    else:
+        account_id = None
 
-    active_account_id = get_json_from_file(active_account_file).get('id', '')
+    if want_upload_status:
+        # returning True means there are results that need uploading
+        return results_index.has_pending(account_id)
+
+    return [stored_result(row) for row in results_index.results(account_id)]
+
+def stored_result(row) -> Dict[str, Any]:
+    """Make the stored result sent to the GUI from a row of the results index."""
+    date_time = datetime.datetime.fromtimestamp(row["timestamp"]).strftime('%Y-%m-%d %H:%M:%S')
+    data = {}
+    data['N1'] = row['N1']
+    data['N2'] = row['N2']
+    data['K'] = row['K']
+    data['P'] = row['P']
+    result = {
+            "timestamp": date_time,
+            "data": data,
+            "barcode": row["barcode"],
+            "data_id": row["data_id"],
+            "sample_id": row["sample_id"],
+            "uploaded": bool(row["uploaded"]),
+            "account_id": row["account_id"],    ## NMR TODO should be int
+            "account_name": row["account_name"],
+            "local_id": row["local_id"],
+    }
+    return result
 
-    for f in sorted(glob.glob(os.path.join(stored_results_directory, "*.results.txt"))):
+def date_to_timestamp(date: str) -> int:
+    """Get the time in seconds of the start of a date given as YYYY-MM-DD."""
+    return int(datetime.datetime.strptime(date, '%Y-%m-%d').timestamp())
 
-        # skip any file that returns error
-        try:
-            values = read_analysis(f)
+def stream_json_list(items: Iterator[Any]) -> Iterator[str]:
+    """Make a JSON list a part at a time, so it can be sent while made."""
+    yield '['
+    for index, item in enumerate(items):
+        if index > 0:
+            yield ', '
+        yield json.dumps(item)
+    yield ']'
 
-            proceed = False
-            if active_account_only:
-                if active_account_id == values["account_id"]:
-                    proceed = True
-            else:
-                proceed = True
-
-            if proceed:
-                name_info = os.path.basename(f).split(".")
-                date_time = datetime.datetime.fromtimestamp(
-                    int(name_info[0])).strftime('%Y-%m-%d %H:%M:%S')
-                barcode = values["barcode"]
-                data = {}
-                data['N1'] = values['N1']
-                data['N2'] = values['N2']
-                data['K'] = values['K']
-                data['P'] = values['P']
-                result = {"timestamp": date_time, "data": data, "barcode": barcode}   ## NMR XX
-                if values["uploaded"] == 'True':
-                    uploaded = True
-                else:
-                    uploaded = False
-                    if want_upload_status:
-                        # returning True means there are results that need uploading
-                        return True
-
-                result = {
-                        "timestamp": date_time,
-                        "data": data,
-                        "barcode": values["barcode"],
-                        "data_id": values["data_id"],
-                        "sample_id": values["sample_id"],
-                        "uploaded": uploaded,
-                        "account_id": values["account_id"],    ## NMR TODO should be int
-                        "account_name": values["account_name"],
-                        "local_id": name_info[0],
-                }
+@app.route("/api/analysis/stored_results", methods=["GET"])
+def stored_results() -> Response:
+    """Get the stored results of the active account, newest first.
+
+    Optional arguments:
+        limit: The most results to get.
+        before: Only results older than this local_id. Give the local_id of
+            the last result of a page to get the next page.
+        after: Only results newer than this local_id.
+        barcode: Only results with this barcode.
+        from, to: Only results analysed from and to these dates (YYYY-MM-DD).
+
+    The results are sent as they are read from the results index. An ETag
+    is sent, and if it matches If-None-Match nothing is sent but a 304.
+    """
+    try:
+        account_id = get_json_from_file(active_account_file).get('id', '')
+        args = request.args
+        limit = int(args["limit"]) if "limit" in args else None
+        before = int(args["before"]) if "before" in args else None
+        after = int(args["after"]) if "after" in args else None
+        if "to" in args:
+            end = date_to_timestamp(args["to"]) + 24 * 60 * 60
+            before = end if before is None else min(before, end)
+        if "from" in args:
+            start = date_to_timestamp(args["from"]) - 1
+            after = start if after is None else max(after, start)
+        barcode = args.get("barcode")
+    except Exception as e:
+        return Response(repr(e), 400)
 
-                results.append(result)
-        except Exception:
-            pass
+    # The same when neither the index nor the query has changed
+    etag_source = json.dumps([results_index.version(), account_id, sorted(args.items())])
+    etag = hashlib.sha1(etag_source.encode()).hexdigest()
+    if etag in request.if_none_match:
+        return Response(status=304, headers={"ETag": f'"{etag}"'})
 
+    rows = results_index.query(account_id, before, after, barcode, limit)
+    results = (stored_result(row) for row in rows)
+    return Response(stream_json_list(results), 200, mimetype='application/json', headers={"ETag": f'"{etag}"'})
 
-    if want_upload_status:
-        # returning True means there are results that need uploading
+@app.route("/api/analysis/upload_queue", methods=["POST"])
+def analysis_upload_queue() -> Response:
+    """Queue the upload of results and return the job id right away.
+
+    Takes the same arguments as /api/analysis/upload, except store_local.
+    Without local_id the results of the last analysis are stored first.
+    """
+    local_id = request.form.get("local_id", None)
+    new_sample = request.form.get("new_sample", "false") == 'true'
+    has_sample_id = 'sample_id' in request.form.to_dict()
+    sample_id = request.form.get("sample_id", '')
+
+    try:
+        if not local_id:
+            if not os.path.isfile(results_file):
+                return Response("Results file not found", 422)
+            local_id = str(int(os.path.getmtime(results_file)))
+            write_stored_results(False, "", sample_id, None)
+        elif results_index.get(local_id) is None:
+            return Response(f'no file found called {local_id}.results.txt', 422)
+        job_id = upload_queue.add(local_id, new_sample, has_sample_id, sample_id)
+        return Response(json.dumps({"job_id": job_id, "local_id": local_id}), 202)
+    except Exception as e:
+        utils.backend_logger(f'{str(e)}')
+        return Response("Error: failed to queue upload", 422)
+
+@app.route("/api/analysis/upload_queue/<job_id>", methods=["GET"])
+def analysis_upload_job(job_id: str) -> Response:
+    """Get the status of an upload job.
+
+    The status is one of queued, uploading, done, needs_user and failed.
+    The result is the response the upload gave, as from /api/analysis/upload.
+    """
+    job = upload_queue.get(job_id)
+    if job is None:
+        return Response(f'no upload job {job_id}', 404)
+    return Response(json.dumps(job), 200)
+
+def upload_job(job: uploadqueue.Job):
+    """Upload the stored results of a job from the upload queue.
+
+    Returns:
+        The status of the job, the result to show for it and the console
+        sample the next try must upload to, as JSON, or None.
+    """
+    with upload_lock:
+        row = results_index.get(job["local_id"])
+        if row is None:
+            return uploadqueue.FAILED, f'no file found called {job["local_id"]}.results.txt', None
+        if row["uploaded"]:
+            # uploaded by the user meanwhile
+            return uploadqueue.DONE, "already uploaded", None
+        if job["sample"] is not None:
+            # an earlier try made or found the sample, only the results are
+            # uploaded to it, with the sample_id stored with them
+            body, status, retry, sample = upload_results(job["local_id"], False, False, False, '',
+                                                         json.loads(job["sample"]))
+        else:
+            body, status, retry, sample = upload_results(job["local_id"], False, bool(job["new_sample"]),
+                                                         bool(job["has_sample_id"]), job["sample_id"])
+    sample = None if sample is None else json.dumps(sample)
+    if retry:
+        return uploadqueue.RETRY, body, sample
+    if status != 200:
+        return uploadqueue.FAILED, body, None
+    # the cases not uploaded need the user to decide what to do
+    if json.loads(body).get("uploaded"):
+        return uploadqueue.DONE, body, None
+    return uploadqueue.NEEDS_USER, body, None
+
+def console_connected() -> bool:
+    """Check if the console can be reached and the user is logged in."""
+    if not os.path.isfile(credentials_file):
         return False
+    message, status = console_client.hello()
+    return status == 401
 
-    return results
+@app.route("/api/metrics", methods=["GET"])
+def metrics() -> Response:
+    """Get p50 and p95 in seconds of each sample check stage.
 
-@app.route("/api/analysis/stored_results", methods=["GET"])
-def stored_results() -> Response:
-    results = read_stored_results(False, True)
-    results = list(reversed(results))
-    return Response(json.dumps(results), 200)
+    The optional runs argument sets how many of the last runs to use.
+    """
+    try:
+        last = int(request.args.get("runs", config.trace_max_runs))
+        runs = tracing.read_runs(config.trace_file, last)
+        return Response(json.dumps({"runs": len(runs), "stages": tracing.stage_percentiles(runs)}), 200)
+    except Exception as e:
+        return Response(repr(e), 400)
 
 @app.route("/api/analysis/uploadtest", methods=["POST"])
 def upload_test() -> Response:
@@ -337,6 +458,48 @@ def analysis_upload() -> Response:
     new_sample = request.form.get("new_sample", "false")
     new_sample = { 'true' : True, 'false' : False }.get(new_sample)
 
+    has_sample_id = 'sample_id' in request.form.to_dict()
+    sample_id = request.form.get("sample_id", '')
+
+    if local_id:
+        stored_id = local_id
+    elif os.path.isfile(results_file):
+        # the name the results get when stored
+        stored_id = str(int(os.path.getmtime(results_file)))
+
+    with upload_lock:
+        body, status, retry, sample = upload_results(local_id, store_local, new_sample, has_sample_id, sample_id)
+    if retry and sample is not None:
+        # the sample is on the console, only the results are uploaded again
+        # with the sample_id stored with them
+        upload_queue.add(stored_id, False, False, '', json.dumps(sample))
+    elif retry:
+        # the results are stored, the upload queue tries again later
+        upload_queue.add(stored_id, bool(new_sample), has_sample_id, sample_id)
+    return Response(body, status)
+
+def upload_results(local_id: Optional[str], store_local: bool, new_sample: bool, has_sample_id: bool,
+                   sample_id: str, sample: Any = None):
+    """Upload the results of the last analysis or of a stored analysis.
+
+    Only the failures before anything was written to the console are tried
+    again as they were. Once the console sample is made or found, a retry
+    must only upload the results to that sample, or the sample would be
+    made again.
+
+    Parameters:
+        local_id: The stored results to upload, None for the last analysis.
+        store_local: Only store the results of the last analysis.
+        new_sample: Make a new sample for the results, instead of finding one.
+        has_sample_id: The sample id was given by the user.
+        sample_id: The sample id given.
+        sample: The console sample to upload to, made or found by an earlier
+            try, None to make or find it.
+    Returns:
+        The response text, the response status, if the upload should be
+        tried again later and the console sample the retry must upload to,
+        None to make or find it again.
+    """
     message, status = console_client.hello()
 
     noNetwork = False
@@ -345,13 +508,13 @@ def analysis_upload() -> Response:
 
     if local_id:
         if noNetwork:
-            return Response(f'no network', 422)
+            return f'no network', 422, True, None
 
         files = glob.glob(os.path.join(stored_results_directory, f'{local_id}.results.txt'))
         if files:
             if len(files) > 1:
                 utils.backend_logger(f'More than one stored file found with name: {local_id}.results.txt')
-                return Response("More than one stored file was found", 422)
+                return "More than one stored file was found", 422, False, None
             stored_results_file = files[0]
             values = read_analysis(stored_results_file)
             barcode = values['barcode']
@@ -359,10 +522,7 @@ def analysis_upload() -> Response:
             account_id = values["account_id"]
             account_name = values["account_name"]
             ## NMR check id sample_id is in the request, otherwise lift it from the stored_results file
-            has_sample_id = 'sample_id' in request.form.to_dict()
-            if has_sample_id:
-                sample_id = request.form.get("sample_id", '')
-            else:
+            if not has_sample_id:
                 sample_id = values["sample_id"]
                 if sample_id:
                     has_sample_id = True
@@ -382,12 +542,12 @@ def analysis_upload() -> Response:
             phosphate_file = f'{stored_images_directory}/{local_id}.phosphate.png'
         else:
             utils.backend_logger(f'no file found called {local_id}.results.txt')
-            return Response(f'no file found called {local_id}.results.txt', 422)
+            return f'no file found called {local_id}.results.txt', 422, False, None
 
     else:
         if not os.path.isfile(results_file):
             utils.backend_logger(f'Results file not found')
-            return Response("Results file not found", 422)       ## NMR no results_file available
+            return "Results file not found", 422, False, None       ## NMR no results_file available
 
         stored_results_file = None
         #user_options = get_json_from_file(user_options_file)
@@ -405,8 +565,6 @@ def analysis_upload() -> Response:
         account_data = json.loads(get_file_data(active_account_file))
         account_name = account_data["name"]
         account_id = account_data["id"]
-        has_sample_id = 'sample_id' in request.form.to_dict()
-        sample_id = request.form.get("sample_id", '')
         nitrate_file = f'{results_directory}/nitrate/sample.png'
         phosphate_file = f'{results_directory}/phosphate/sample.png'
 
@@ -428,7 +586,7 @@ def analysis_upload() -> Response:
                 'uploaded' : False,
                 'stored' : True
                 }
-        return Response(json.dumps(case7), 200)
+        return json.dumps(case7), 200, False, None
 
     if new_sample:
         ##############
@@ -460,7 +618,7 @@ def analysis_upload() -> Response:
                         'stored' : False,
                         'local_id' : local_id
                         }
-                return Response(json.dumps(case8), 200)
+                return json.dumps(case8), 200, False, None
             if 'A sample with this barcode already exists in this account' in message:
                 case8 = {
                         'case' : 'case9',
@@ -469,10 +627,12 @@ def analysis_upload() -> Response:
                         'stored' : False,
                         'local_id' : local_id
                         }
-                return Response(json.dumps(case8), 200)
+                return json.dumps(case8), 200, False, None
             utils.backend_logger(f'upload error 1: {status} : {message}')
             write_stored_results(False, "", sample_id, stored_results_file)
-            return Response("upload error 1", 422)
+            # the sample may have been made if the request reached the console
+            retry = noNetwork or message == console_client.connection_error
+            return "upload error 1", 422, retry, None
 
         message_s = json.loads(message)
         sample = message_s['id']
@@ -488,7 +648,7 @@ def analysis_upload() -> Response:
         if not (status >= 200 and status < 400):
             utils.backend_logger(f'upload error 2: {status} : {message}')
             write_stored_results(False, "", sample_id, stored_results_file)
-            return Response("upload error 2", 422)#message_s = json.loads(message)
+            return "upload error 2", 422, True, sample#message_s = json.loads(message)
         message_s = json.loads(message)
 
         spaimage_data = {"sample": sample, "image": "sample.png", "tag": f'nitrate : {spa_data.get("N1")}'}
@@ -498,7 +658,7 @@ def analysis_upload() -> Response:
         if not (status >= 200 and status < 400):
             utils.backend_logger(f'upload error 3: {status} : {message}')
             #write_stored_results(False, "", sample_id, stored_results_file)
-            #return Response("upload error 3", 422)
+            #return "upload error 3", 422, False
         spaimage_data = {"sample": sample, "image": "sample.png", "tag": f'phosphate : {spa_data.get("P")}'}
         status = 500
         if not noNetwork:
@@ -506,7 +666,7 @@ def analysis_upload() -> Response:
         if not (status >= 200 and status < 400):
             utils.backend_logger(f'upload error 4: {status} : {message}')
             #write_stored_results(False, "", sample_id, stored_results_file)
-            #return Response("upload error 4", 422)
+            #return "upload error 4", 422, False
 
         data_id = message_s['data_id']
         case5 = {
@@ -526,50 +686,51 @@ def analysis_upload() -> Response:
         write_stored_results(True, data_id, sample_id, stored_results_file)
 
         if use_barcode:
-            return Response(json.dumps(case5), 200)
+            return json.dumps(case5), 200, False, None
         else:
-            return Response(json.dumps(case6), 200)
+            return json.dumps(case6), 200, False, None
 
     else:
-        ########
-        # find sample
-        data = {
-            'account' : account_id,
-            }
+        if sample is None:
+            ########
+            # find sample
+            data = {
+                'account' : account_id,
+                }
 
-        if use_barcode:
-            data["use_barcode"] = True
-            data["barcode"] = barcode
-            data["sample_id"] = ""
-        else:
-            data["use_barcode"] = False
-            data["barcode"] = ""
-            data["sample_id"] = sample_id
+            if use_barcode:
+                data["use_barcode"] = True
+                data["barcode"] = barcode
+                data["sample_id"] = ""
+            else:
+                data["use_barcode"] = False
+                data["barcode"] = ""
+                data["sample_id"] = sample_id
 
-        status = 500
-        if not noNetwork:
-            message, status = console_client.find_sample(data)
+            status = 500
+            if not noNetwork:
+                message, status = console_client.find_sample(data)
 
-        if not (status >= 200 and status < 400):
-            utils.backend_logger(f'upload error 5: {status} : {message}')
-            write_stored_results(False, "", sample_id, stored_results_file)
-            return Response("upload error 5", 422)
+            if not (status >= 200 and status < 400):
+                utils.backend_logger(f'upload error 5: {status} : {message}')
+                write_stored_results(False, "", sample_id, stored_results_file)
+                return "upload error 5", 422, True, None
 
-        message_s = json.loads(message)
+            message_s = json.loads(message)
 
-        if message_s:
-            if len(message_s) > 1:
-                utils.backend_logger(f'upload error 6 :More than one sample found: {len(message_s)}')
-                write_stored_results(False, "", "", stored_results_file)
-                return Response("upload error 6", 422)
-            sample = message_s[0]['id']
-            sample_id = message_s[0]['sample_id']
-        else:
-            sample = None
+            if message_s:
+                if len(message_s) > 1:
+                    utils.backend_logger(f'upload error 6 :More than one sample found: {len(message_s)}')
+                    write_stored_results(False, "", "", stored_results_file)
+                    return "upload error 6", 422, False, None
+                sample = message_s[0]['id']
+                sample_id = message_s[0]['sample_id']
+            else:
+                sample = None
 
-        #return None, sample_id
-        ##############################
-        #sample, sample_id = find_sample(account_id, sample_id, barcode, use_barcode)
+            #return None, sample_id
+            ##############################
+            #sample, sample_id = find_sample(account_id, sample_id, barcode, use_barcode)
         if sample:
             spa_data["sample"] = sample
             status = 500
@@ -580,7 +741,7 @@ def analysis_upload() -> Response:
             if not (status >= 200 and status < 400):
                 utils.backend_logger(f'upload error 7: {status} : {message}')
                 write_stored_results(False, "", sample_id, stored_results_file)
-                return Response("upload error 7", 422)
+                return "upload error 7", 422, True, sample
 
             message_s = json.loads(message)
 
@@ -589,7 +750,7 @@ def analysis_upload() -> Response:
             if not (status >= 200 and status < 400):
                 utils.backend_logger(f'upload error 8: {status} : {message}')
                 #write_stored_results(False, "", sample_id, stored_results_file)
-                #return Response("upload error 8", 422)
+                #return "upload error 8", 422, False
             spaimage_data = {"sample": sample, "image": "sample.png", "tag": f'phosphate : {spa_data.get("P")}'}
             status = 500
             if not noNetwork:
@@ -597,7 +758,7 @@ def analysis_upload() -> Response:
             if not (status >= 200 and status < 400):
                 utils.backend_logger(f'upload error 9: {status} : {message}')
                 #write_stored_results(False, "", sample_id, stored_results_file)
-                #return Response("upload error 9", 422)
+                #return "upload error 9", 422, False
 
             data_id = message_s['data_id']
             write_stored_results(True, data_id, sample_id, stored_results_file)
@@ -617,9 +778,9 @@ def analysis_upload() -> Response:
                     }
 
             if use_barcode:
-                return Response(json.dumps(case3), 200)
+                return json.dumps(case3), 200, False, None
             else:
-                return Response(json.dumps(case4), 200)
+                return json.dumps(case4), 200, False, None
 
 
         else:
@@ -641,9 +802,9 @@ def analysis_upload() -> Response:
                     'local_id': local_id
                     }
             if use_barcode:
-                return Response(json.dumps(case1), 200)
+                return json.dumps(case1), 200, False, None
             else:
-                return Response(json.dumps(case2), 200)
+                return json.dumps(case2), 200, False, None
 
 def save_images(timestamp: str) -> None:
     """
@@ -703,6 +864,7 @@ def write_stored_results(uploaded: bool, data_id: str, sample_id: str, stored_re
             \nsample_id: {sample_id}\
             \naccount_name: {account_name}\
             \naccount_id: {account_id}')
+        index_stored_results(file)
 
     else:
         results_time = os.path.getmtime(results_file)
@@ -735,10 +897,23 @@ def write_stored_results(uploaded: bool, data_id: str, sample_id: str, stored_re
             \naccount_id: {account_data["id"]}')
 
         shutil.move(results_file, os.path.join(stored_results_directory, filename_new))
+        index_stored_results(os.path.join(stored_results_directory, filename_new))
 
         save_images(timestamp)
 
 
+def index_stored_results(stored_results_file: str) -> None:
+    """Update the results index with a stored results file just written."""
+    try:
+        mtime = os.path.getmtime(stored_results_file)
+        values = read_analysis(stored_results_file)
+        results_index.put(resultsindex.ResultsIndex.local_id(stored_results_file), values, mtime)
+    except Exception as e:
+        # The file is newer than its row in the index, so it is read again by
+        # the sync at the next start
+        utils.backend_logger(f'Could not index {stored_results_file} {repr(e)}')
+
+
 def get_file_data(filename: str) -> str:
     if not os.path.isfile(filename):
         return ""
@@ -1022,6 +1197,11 @@ def read_device_name(device_filename: str) -> str:
         #return int(datafile.read())
         return datafile.read().strip('\n')
 
+# Index the stored results not indexed yet, all of them on the first start
+results_index.sync(stored_results_directory, read_analysis)
+
+threading.Thread(target=upload_queue.run, args=(upload_job, console_connected), daemon=True).start()
+
 # Serve React App
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
@@ -76,16 +76,22 @@ if __name__ == '__main__':
             camera.setlight(colortable[color])
 
 import sys
-from os import makedirs, getpid
+import json
+from os import makedirs, getpid, replace as replacefile
 from time import clock_gettime, CLOCK_MONOTONIC
-from typing import List, Tuple
+from typing import Iterator, List, Optional, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor
+import numpy as np
 
 from utils import *
 from checksample_com import Status,  store_daemon_pid
 import predictNewSample
+import predictor
+import newdetect
+import tracing
 
 
-CaptureInfo = Tuple[int, str, str]
+CaptureInfo = Tuple[int, str, str, np.ndarray]
 
 
 class CheckSampleException(Exception):
@@ -104,6 +110,15 @@ class AbortCheckException(CheckSampleException):
         super().__init__(self, "Request for aborting current check.")
 
 
+class CartridgeNotInRoiException(CheckSampleException):
+
+    """Exception for a cartridge not found in the region of interest captured."""
+
+    def __init__(self, score: Optional[float]) -> None:
+        """Init function giving a description with the template match score."""
+        super().__init__("Cartridge not found in the region of interest, template match score {0}.".format(score))
+
+
 def capture(camera: Camera, dirname: str, filename: str) -> None:
     """Capture the image needed to analyse a sample.
 
@@ -121,16 +136,19 @@ def capture(camera: Camera, dirname: str, filename: str) -> None:
     camera.setlight(colortable['off'])
 
 
-def capture_all(camera: Camera, basedirname: str, filename: str, starttime: float) -> List[CaptureInfo]:
-    """Capture all needed images for full analysis.
+def capture_spots(camera: Camera, basedirname: str, filename: str, starttime: float,
+                  save: bool = True) -> Iterator[CaptureInfo]:
+    """Capture the images of the spots, giving each as soon as it is captured.
 
     Parameters:
         camera: The Camera object to use for capture.
         basedirname: The work dir to put things in.
         filename: Name of image files.
         starttime: The starttime for capture time calculations.
+        save: Save the images to the image files. If False the caller must
+            save them, as the files are needed for archiving and upload.
     Returns:
-        List of (spot number, image dir, image file).
+        Iterator of (spot number, image dir, image file, image) in capture order.
 
     """
     worklist = []
@@ -138,31 +156,155 @@ def capture_all(camera: Camera, basedirname: str, filename: str, starttime: floa
         if active:
             worklist.append((analyseconfig.spot_timing[spotindex], spotindex))
     worklist.sort()
-    capturelist = []
     for capturetime, spotindex in worklist:
         camera.setlight(colortable[analyseconfig.spot_light_color[spotindex]])
-        camera.capture_average([x + capturetime for x in analyseconfig.average_times], starttime)
+        with tracing.span("capture_average"):
+            camera.capture_average([x + capturetime for x in analyseconfig.average_times], starttime,
+                                   window=analyseconfig.stream_window)
         camera.setlight(colortable['off'])
         dirname = path.join(basedirname, analyseconfig.spot_model_names[spotindex])
         makedirs(path.abspath(dirname), exist_ok=True)
-        camera.save_image(path.join(dirname, filename))
+        if save:
+            with tracing.span("save_image"):
+                camera.save_image(path.join(dirname, filename))
         spot = spotindex + 1
-        capturelist.append((spot, dirname, filename))
-    return capturelist
+        # capture_average leaves a new array in the buffer for every spot,
+        # so we can keep a reference to it for the analysis.
+        yield (spot, dirname, filename, camera.buf.array)
+
+
+def capture_all(camera: Camera, basedirname: str, filename: str, starttime: float) -> List[CaptureInfo]:
+    """Capture all needed images for full analysis.
+
+    Parameters:
+        camera: The Camera object to use for capture.
+        basedirname: The work dir to put things in.
+        filename: Name of image files.
+        starttime: The starttime for capture time calculations.
+    Returns:
+        List of (spot number, image dir, image file, image).
+
+    """
+    return list(capture_spots(camera, basedirname, filename, starttime))
+
+
+def analyse_spot(captureinfo: CaptureInfo, results: Results, mask_cache: newdetect.MaskCache,
+                 roi: Optional[newdetect.FrameRoi] = None) -> None:
+    """Analyse a single captured spot.
+
+    Parameters:
+        captureinfo: The (spot number, image dir, image file, image) to analyse.
+        results: Results to put the prediction in.
+        mask_cache: Circle masks shared between the spots of the sample.
+        roi: The part of the camera frame captured. None for the whole frame.
+
+    """
+    spot, dirname, filename, image = captureinfo
+    predictNewSample.predict_sample(dirname, filename, [spot], results, image, mask_cache, roi)
+
+
+def save_spot_image(camera: Camera, captureinfo: CaptureInfo) -> None:
+    """Save the image of a captured spot to its image file.
+
+    Parameters:
+        camera: The Camera object used for the capture.
+        captureinfo: The (spot number, image dir, image file, image) to save.
+
+    """
+    spot, dirname, filename, image = captureinfo
+    with tracing.span("save_image"):
+        camera.save_image(path.join(dirname, filename), image)
+
+
+def load_roi(camera: Camera) -> Optional[newdetect.FrameRoi]:
+    """Load the region of interest calibrated for this device.
+
+    Parameters:
+        camera: The Camera the region is used with.
+    Returns:
+        The region or None if not calibrated yet or made for another
+        camera resolution.
+
+    """
+    try:
+        with open(analyseconfig.roi_file) as fh:
+            roi = newdetect.FrameRoi(**json.load(fh))
+    except FileNotFoundError:
+        return None
+    if (roi.frameWidth, roi.frameHeight) != tuple(camera.capture_resulution):
+        return None
+    return roi
+
+
+def save_roi(roi: newdetect.FrameRoi) -> None:
+    """Store the region of interest calibrated for this device.
+
+    Parameters:
+        roi: The region to store.
+
+    """
+    makedirs(path.dirname(path.abspath(analyseconfig.roi_file)), exist_ok=True)
+    tmp_file = analyseconfig.roi_file + ".tmp"
+    with open(tmp_file, "w") as fh:
+        json.dump(roi.toDict(), fh)
+    replacefile(tmp_file, analyseconfig.roi_file)
+
+
+def forget_roi() -> None:
+    """Remove the stored region of interest, so the whole frame is used."""
+    try:
+        removefile(analyseconfig.roi_file)
+    except FileNotFoundError:
+        pass
+
+
+def recalibrate_roi(camera: Camera, roi: Optional[newdetect.FrameRoi], masks: newdetect.SpotMasks) -> bool:
+    """Store a new region of interest around the circles found, if it changed.
+
+    Circles found with a template match score below roi_min_score are not
+    trusted, as with an empty or misplaced cartridge. Then no region is
+    stored, and a region the circles were searched in is forgotten, so the
+    next check searches the whole frame again.
+
+    Parameters:
+        camera: The Camera used.
+        roi: The region the circles were found in. None for the whole frame.
+        masks: The circles found.
+    Returns:
+        True if the circles were trusted.
+
+    """
+    if masks.score is None or masks.score < analyseconfig.roi_min_score:
+        print("Template match score {0} too low to calibrate the region of interest".format(masks.score))
+        if roi is not None:
+            print("Using the whole camera frame from the next check")
+            forget_roi()
+        return False
+    if roi is None:
+        width, height = camera.capture_resulution
+        roi = newdetect.FrameRoi(0, 0, width, height, width, height)
+    new_roi = newdetect.FrameRoi.around(masks, roi)
+    if new_roi != roi:
+        print("New camera region of interest: {0}".format(new_roi.toDict()))
+        save_roi(new_roi)
+    return True
 
 
 def analyse_all(capturelist: List[CaptureInfo]) -> Results:
     """Analyse all the spots we are looking at.
 
     Parameters:
-        capturelist: A list of (spot number, image dir, image file)
+        capturelist: A list of (spot number, image dir, image file, image)
     Returns:
         Results of the analysis.
 
     """
     results = create_default_results()
-    for spot, dirname, filename in capturelist:
-        predictNewSample.predict_sample(dirname, filename, [spot], results)
+    # All spots are on the same cartridge, so the circles found in the first
+    # image can be reused for the rest as long as the cartridge stays put.
+    mask_cache = newdetect.MaskCache(analyseconfig.mask_drift_limit)
+    for captureinfo in capturelist:
+        analyse_spot(captureinfo, results, mask_cache)
     return results
 
 
@@ -172,17 +314,70 @@ def check_sample(camera: Camera, starttime: float, resultdir: str = analyseconfi
     This will do all the work needed to check a sample:
     Capture, pre processing, analysis, post processing.
 
+    The time used by each stage is stored in the trace file.
+
+    Parameters:
+        resultdir: The directory where work files and results should be placed.
+
+    """
+    tracing.start_run()
+    try:
+        capture_and_analyse(camera, starttime, resultdir)
+    finally:
+        try:
+            tracing.finish_run(analyseconfig.trace_file, analyseconfig.trace_max_runs)
+        except OSError as e:
+            print("Could not store the trace: {0}".format(e))
+
+
+def capture_and_analyse(camera: Camera, starttime: float, resultdir: str) -> None:
+    """Capture, pre process, analyse and post process a sample.
+
     Parameters:
         resultdir: The directory where work files and results should be placed.
 
     """
     makedirs(path.abspath(resultdir), exist_ok=True)
-    # Capture images of the sample
-    print("Capturing")
-    capturelist = capture_all(camera, resultdir, analyseconfig.sample_filename, starttime)
-    # Do the prediction
-    results = analyse_all(capturelist)
-    save_results(resultdir, analyseconfig.results_filename, results)
+    results = create_default_results()
+    mask_cache = newdetect.MaskCache(analyseconfig.mask_drift_limit)
+    # Only capture and process the part of the frame with the cartridge
+    roi = load_roi(camera) if analyseconfig.use_roi else None
+    camera.roi = None if roi is None else (roi.x, roi.y, roi.width, roi.height)
+    # Each spot is analysed on a worker thread as soon as it is captured, so
+    # the analysis runs while we wait for the chemistry of the next spot.
+    # A single worker keeps the spots in capture order for the mask cache.
+    # The analysis gets the captured array directly, and the PNG only needed
+    # for archiving and upload is written by the worker after the analysis.
+    analyser = ThreadPoolExecutor(max_workers=1)
+    pending: List[Future] = []
+    wait = True
+    try:
+        print("Capturing")
+        for captureinfo in capture_spots(camera, resultdir, analyseconfig.sample_filename, starttime, save=False):
+            pending.append(analyser.submit(analyse_spot, captureinfo, results, mask_cache, roi))
+            pending.append(analyser.submit(save_spot_image, camera, captureinfo))
+        # Time left waiting for the analysis after the last capture
+        with tracing.span("analyse_wait"):
+            for future in pending:
+                # Raises any exception from the analysis here
+                future.result()
+    except AbortCheckException:
+        # Do not make the abort wait for the spots queued. Only the one being
+        # analysed goes on, in the background.
+        for future in pending:
+            future.cancel()
+        wait = False
+        raise
+    finally:
+        analyser.shutdown(wait=wait)
+    # Follow the cartridge if it is placed differently over time
+    if analyseconfig.use_roi and mask_cache.masks is not None:
+        if not recalibrate_roi(camera, roi, mask_cache.masks) and roi is not None:
+            # The spots were only captured in the region, so the cartridge
+            # may be partly outside of what was analysed
+            raise CartridgeNotInRoiException(mask_cache.masks.score)
+    with tracing.span("save_results"):
+        save_results(resultdir, analyseconfig.results_filename, results)
 
 
 def single_check() -> None:
@@ -268,6 +463,8 @@ class Daemon():
         """Run the daemon loop."""
         log(logfile, "Check sample daemon started")
         self.running_daemon = True
+        # Keep the models in memory so a check does not wait for reading them
+        predictor.registry.load()
         camera.wait_for_ready(wait_for_light=False)
         while self.running_daemon:
             Status.set_status(Status.READY)
@@ -48,3 +48,9 @@ checksample_status_file = tmp_dir + "/checksample.status"
 
 checksample_pid_file = tmp_dir + "/checksample.pid"
 """File with the checksample daemon PID. Should not be inside results_dir."""
+
+trace_file = log_dir + "/trace.jsonl"
+"""File with the time used by each stage of the last sample checks."""
+
+trace_max_runs = 200
+"""Number of sample checks kept in the trace file."""
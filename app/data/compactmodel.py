@@ -0,0 +1,164 @@
+"""Compact model module
+
+    Stores the prediction models as plain coefficient arrays in a versioned
+    .npz file instead of a pickle. Loading them needs numpy only, no sklearn
+    and no unpickling of arbitrary objects.
+
+    Export pickled models with:
+        $ python3 compactmodel.py models/nitrate/nitrate-1.p ...
+
+    Every model of a supported type gets a .npz file next to the pickle.
+    The .npz file holds the SHA-256 of the pickle it was exported from, so
+    a pickle replaced without exporting it again is noticed.
+"""
+
+import hashlib
+import os
+import pickle
+import sys
+
+import numpy as np
+
+format_version = 1
+
+
+class CompactPolynomial:
+    """Polynomial model, evaluated with np.polyval."""
+
+    def __init__(self, coef):
+        self.coef = np.asarray(coef, dtype=np.float64)
+
+    def predict(self, x):
+        return np.polyval(self.coef, np.squeeze(x, axis=-1))
+
+
+class CompactMLP:
+    """Multi-layer perceptron regressor with the layout used by sklearn."""
+
+    activations = {
+        'identity': lambda a: a,
+        'logistic': lambda a: 1.0 / (1.0 + np.exp(-a)),
+        'tanh': np.tanh,
+        'relu': lambda a: np.maximum(a, 0),
+    }
+
+    def __init__(self, coefs, intercepts, activation):
+        self.coefs = [np.asarray(c, dtype=np.float64) for c in coefs]
+        self.intercepts = [np.asarray(i, dtype=np.float64) for i in intercepts]
+        self.activation = activation
+
+    def predict(self, x):
+        hidden = self.activations[self.activation]
+        a = np.asarray(x, dtype=np.float64)
+        last = len(self.coefs) - 1
+        for layer, (coef, intercept) in enumerate(zip(self.coefs, self.intercepts)):
+            a = np.dot(a, coef) + intercept
+            if layer < last:
+                a = hidden(a)
+        if a.shape[1] == 1:
+            return a.ravel()
+        return a
+
+
+def compact_path(model_path):
+    '''Get the path of the compact file belonging to a pickled model file.'''
+    return os.path.splitext(model_path)[0] + '.npz'
+
+
+def file_hash(path):
+    '''Get the SHA-256 hex digest of the contents of a file.'''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def export(model, path, source=None):
+    '''Write a model in the compact format.
+
+    args:
+        model: A polynomial.Polynomial or sklearn MLPRegressor model.
+        path(string): The .npz file to write.
+        source(string): The pickle file the model was read from. Its hash is
+            stored, so is_current can tell if the pickle has changed since.
+
+    returns:
+        True if written, False if the model type is not supported.
+    '''
+    if hasattr(model, 'coef') and hasattr(model, 'order'):
+        arrays = {'type': np.array('polynomial'), 'coef': np.asarray(model.coef, dtype=np.float64)}
+    elif hasattr(model, 'coefs_') and getattr(model, 'out_activation_', None) == 'identity' \
+            and model.activation in CompactMLP.activations:
+        arrays = {'type': np.array('mlp'), 'activation': np.array(model.activation),
+                  'layers': np.array(len(model.coefs_))}
+        for layer, (coef, intercept) in enumerate(zip(model.coefs_, model.intercepts_)):
+            arrays['coef%d' % layer] = coef
+            arrays['intercept%d' % layer] = intercept
+    else:
+        return False
+    if source is not None:
+        arrays['source_sha256'] = np.array(file_hash(source))
+    # Write to a temporary file so the model is never seen half written
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, version=np.array(format_version), **arrays)
+    os.replace(tmp_path, path)
+    return True
+
+
+def load(path):
+    '''Load a model written by export.
+
+    args:
+        path(string): The .npz file to read.
+
+    returns:
+        A CompactPolynomial or CompactMLP model.
+    '''
+    with np.load(path, allow_pickle=False) as data:
+        version = int(data['version'])
+        if version != format_version:
+            raise ValueError("%s has unknown model format version %d" % (path, version))
+        model_type = str(data['type'])
+        if model_type == 'polynomial':
+            return CompactPolynomial(data['coef'])
+        if model_type == 'mlp':
+            layers = range(int(data['layers']))
+            return CompactMLP([data['coef%d' % i] for i in layers],
+                              [data['intercept%d' % i] for i in layers],
+                              str(data['activation']))
+        raise ValueError("%s has unknown model type %s" % (path, model_type))
+
+
+def is_current(path, source):
+    '''Check a compact file was exported from the current version of a pickle.
+
+    args:
+        path(string): The .npz file.
+        source(string): The pickle file it should be exported from.
+
+    returns:
+        True if the .npz file holds the hash of the pickle as it is now.
+    '''
+    with np.load(path, allow_pickle=False) as data:
+        if 'source_sha256' not in data.files:
+            return False
+        return str(data['source_sha256']) == file_hash(source)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage: python3 compactmodel.py model.p ...")
+        sys.exit(1)
+    # The pickles refer to the polynomial module next to this file
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    for model_path in sys.argv[1:]:
+        with open(model_path, 'rb') as f:
+            model = pickle.load(f)
+        path = compact_path(model_path)
+        if export(model, path, model_path):
+            x = np.linspace(0, 255, 256).reshape(-1, 1)
+            difference = np.max(np.abs(model.predict(x) - load(path).predict(x)))
+            print("%s: wrote %s, max difference %g" % (model_path, path, difference))
+        else:
+            print("%s: %s models are not supported, keep using the pickle" % (model_path, type(model).__name__))
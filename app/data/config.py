@@ -23,17 +23,49 @@ stored_results_dir = "/data/stored_results"  # NMR remove TEMP before balena dep
 stored_images_dir = "/data/images"  # NMR remove TEMP before balena deploy!
 """Place to store images."""
 
-base_url = "https://console.nordetect.com"
+results_index_file = data_dir + "/results_index.db"
+"""SQLite index of the results in stored_results_dir."""
+
+upload_queue_file = data_dir + "/upload_queue.db"
+"""SQLite queue of the stored results to upload in the background."""
+
+upload_retry_min_time = 30
+"""Seconds to wait before trying a failed upload again the first time.
+The time is doubled after each failed try."""
+
+upload_retry_max_time = 3600
+"""Longest time in seconds to wait before trying a failed upload again."""
+
+upload_max_attempts = 20
+"""Number of tries before giving up on an upload."""
+
+upload_job_keep_time = 7 * 24 * 3600
+"""Seconds to keep finished upload jobs, so their status can be read."""
+
+base_url = os.environ.get("CONSOLE_BASE_URL", "https://console.nordetect.com")
 #base_url = "http://localhost"
 """Server for remote storing of results."""
 
-port = 443
+port = int(os.environ.get("CONSOLE_PORT", "443"))
 #port = 8000
 """port number on the api server"""
 
 net_timeout = 1
 """timeout in seconds for calls to console API"""
 
+net_connect_retries = 2
+"""Number of times to try connecting to the console API again"""
+
+net_read_retries = 1
+"""Number of times to try reading an answer from the console API again.
+Only used for GET calls."""
+
+net_retry_backoff = 0.2
+"""Seconds to wait before the second retry, doubled for each retry after"""
+
+net_pool_size = 2
+"""Number of connections to the console API kept open"""
+
 credentials_file = tmp_dir + "/creds.txt"
 """Contains the username and access token to connect with console API"""
 
@@ -78,3 +110,9 @@ hello_endpoint = "/api/hello/"
 
 spaimage_endpoint = "/api/spaimages/"
 """api server: add new image to spaimage"""
+
+net_timeouts = {
+    spaimage_endpoint: (net_timeout, 10),
+}
+"""timeouts in seconds for calls to the console API endpoints not using
+net_timeout, either one for all or (connect, read)"""
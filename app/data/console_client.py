@@ -2,14 +2,73 @@
 __copyright__ = "Copyright (C) 2020 Nordetect"
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import NewConnectionError
 import json
 import config
 import os
-from typing import Any, Dict, Tuple
+from typing import Any, Dict, Tuple, Union
 from time import process_time
 import utils
 
 
+def make_session() -> requests.Session:
+    """Make the session used for all calls to the console API.
+
+    The connections to the console are kept open and reused by the calls,
+    so only the first call pays for the TCP and TLS handshakes.
+    Connecting is tried again net_connect_retries times, which is safe for
+    all calls as nothing was sent. Reading the answer is only tried again
+    for GET calls, as a POST may already have been done by the server.
+
+    Returns:
+        The session.
+
+    """
+    retry = Retry(total=config.net_connect_retries + config.net_read_retries,
+                  connect=config.net_connect_retries, read=config.net_read_retries,
+                  backoff_factor=config.net_retry_backoff)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config.net_pool_size, max_retries=retry)
+    new_session = requests.Session()
+    new_session.mount('https://', adapter)
+    new_session.mount('http://', adapter)
+    return new_session
+
+session = make_session()
+"""Session shared by all calls. Replace it with make_session after changing
+the config, e.g. to use a local stand-in server."""
+
+def endpoint_timeout(endpoint: str) -> Union[float, Tuple[float, float]]:
+    """Get the timeout for calls to an endpoint.
+
+    Parameters:
+        endpoint: The endpoint path from config.
+    Returns:
+        The timeout in seconds, or the (connect, read) timeouts.
+
+    """
+    return config.net_timeouts.get(endpoint, config.net_timeout)
+
+connection_error = 'There is a problem connecting with Nordetect server'
+"""Message of a call that could not connect to the console, so nothing was
+done there and the call can be made again."""
+
+def not_sent(error: Exception) -> bool:
+    """Check if a call failed before the request reached the console.
+
+    Parameters:
+        error: The exception raised by the call.
+    Returns:
+        True if connecting failed, False if the console may have done the
+        call, like when no answer was read.
+
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(error, requests.exceptions.ConnectionError) and isinstance(reason, NewConnectionError)
+
 def get_headers() -> Dict[str, str]:
     creds_s = utils.get_file_data(config.credentials_file)
     creds_data = json.loads(creds_s)
@@ -48,7 +107,7 @@ def find_sample(data: Any) -> Tuple[str, int]:
         }
 
     try:
-        raw_response = requests.get(sample_endpoint, params=params, headers=headers, timeout=config.net_timeout)
+        raw_response = session.get(sample_endpoint, params=params, headers=headers, timeout=endpoint_timeout(config.sample_endpoint))
     except Exception as e:
         utils.backend_logger(f'Error finding sample: {str(e)}')
         return f'There is a problem connecting with Nordetect server', 500
@@ -63,10 +122,12 @@ def create_sample(sample_data: Any) -> Tuple[str, int]:
     # use_barcode = user_options["use_barcode"]
 
     try:
-        raw_response = requests.post(sample_endpoint, data=json.dumps(sample_data), headers=headers, timeout=config.net_timeout)
+        raw_response = session.post(sample_endpoint, data=json.dumps(sample_data), headers=headers, timeout=endpoint_timeout(config.sample_endpoint))
     except Exception as e:
         utils.backend_logger(f'Error creating sample: {str(e)}')
-        return f'There is a problem connecting with Nordetect server', 500
+        if not_sent(e):
+            return connection_error, 500
+        return f'There was no answer from Nordetect server', 500
     return raw_response.text, raw_response.status_code
 
 def create_spadata(data: Any) -> Tuple[str, int]:
@@ -75,7 +136,7 @@ def create_spadata(data: Any) -> Tuple[str, int]:
     headers=get_headers()
 
     try:
-        raw_response = requests.post(spadata_endpoint, data=json.dumps(data), headers=headers, timeout=config.net_timeout)
+        raw_response = session.post(spadata_endpoint, data=json.dumps(data), headers=headers, timeout=endpoint_timeout(config.spadata_endpoint))
     except Exception as e:
         utils.backend_logger(f'create spadata error: {str(e)}')
         return f'There is a problem connecting with Nordetect server', 500
@@ -96,7 +157,7 @@ def create_spaimage(data: Any, file: str) -> Tuple[str, int]:
         files = None
 
     try:
-        raw_response = requests.post(spaimage_endpoint, data=data, files=files, headers=headers, timeout=config.net_timeout)
+        raw_response = session.post(spaimage_endpoint, data=data, files=files, headers=headers, timeout=endpoint_timeout(config.spaimage_endpoint))
     except Exception as e:
         utils.backend_logger(f'{str(e)}')
         return f'There is a problem connecting with Nordetect server', 500
@@ -112,11 +173,11 @@ def login(login_data: Dict[str,  str]) -> Tuple[str, int]:
     headers = {'content-type': 'application/json'}
 
     try:
-        raw_response = requests.post(
+        raw_response = session.post(
                 endpoint,
                 headers=headers,
                 data=json.dumps(login_data),
-                timeout=config.net_timeout
+                timeout=endpoint_timeout(config.login_endpoint)
         )
         return raw_response.text, raw_response.status_code
     except Exception as e:
@@ -134,7 +195,7 @@ def user_accounts(creds_data: Dict[str,  str]) -> Tuple[str, int]:
     }
 
     try:
-        raw_response = requests.get(endpoint, headers=headers, timeout=config.net_timeout)
+        raw_response = session.get(endpoint, headers=headers, timeout=endpoint_timeout(config.account_endpoint))
         return raw_response.text, raw_response.status_code
     except Exception as e:
         utils.backend_logger(f'user accounts error: {str(e)}')   ## NMR TODO  see if we can refine this error
@@ -150,7 +211,7 @@ def hello() -> Tuple[str, int]:
 
     try:
         #tstart = process_time()
-        raw_response = requests.get(endpoint, headers=headers, timeout=config.net_timeout)
+        raw_response = session.get(endpoint, headers=headers, timeout=endpoint_timeout(config.hello_endpoint))
         #tend = process_time()
         #print (f'hello {tend - tstart}')
         return raw_response.text, raw_response.status_code
@@ -164,11 +225,11 @@ def upload_error(data: Dict[str,  str]) -> Tuple[str, int]:
     endpoint = f'{config.base_url}:{config.port}{config.device_error_endpoint}'
 
     try:
-        raw_response = requests.post(
+        raw_response = session.post(
                 endpoint,
                 headers=headers,
                 data=json.dumps(data),
-                timeout=config.net_timeout
+                timeout=endpoint_timeout(config.device_error_endpoint)
                 )
         return raw_response.text, raw_response.status_code
     except Exception as e:
@@ -23,6 +23,25 @@ python detectCircles.py calibrate [imagePath]/Pot.png [imagePath]/Phos.png [imag
 
 For 'operational' mode, run with:
 python detectCircles.py operational [imagePath]/Pot.png [imagePath]/Phos.png [imagePath]/Nitra.png [imagePath]/Ammo.png
+
+For 'batch' mode, detecting every image of a folder into one CSV file, run with:
+python detectCircles.py batch [imagePath] [resultsFile.csv]
+Running it again on the same folder resumes where it stopped.
+
+To compare the exhaustive and pyramid template search on a folder of images:
+python detectCircles.py benchmark [imagePath]
+
+To check the edge map stage gives the same skeletons as the original scipy
+version, and time both, on a folder of images (exits with 1 on a mismatch):
+python detectCircles.py edgecheck [imagePath]
+
+It can also be imported as a module. detect() takes an image already in
+memory (BGR numpy array, as delivered by the camera) and returns a
+SpotIntensities object, so callers avoid a subprocess and a round-trip
+through files on disk. SpotIntensities.toDict() gives the whole result,
+with the circle centres, template match and the time used by each stage, as
+plain types, and writeResult() stores it atomically as one JSON file. The
+'lab' and 'training' modes write this JSON record next to their text files.
 '''
 
 from __future__ import print_function
@@ -36,12 +55,14 @@ from skimage.draw import circle_perimeter
 
 import cv2
 import numpy as np
-from scipy.ndimage import morphology
 import sys
 from glob import glob
 import math
 import time
 import os
+import csv
+import json
+import multiprocessing
 
 #****************************Notes to Keenan:*********************************
 #Switch this to True if you would like to see the intermediate images/results
@@ -65,8 +86,556 @@ else:
     cntsNum = 0
 #**************************End Notes to Keenan:*******************************
 
+#the template is found relative to this file, so the module can be used from
+#any working directory
+templatePath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'circleBinTemplate.png')
+
+
+#used as the size to shrink the images down to (makes detecting circles and
+#other computations faster)
+newWidth    = 360
+
+#used to crop out the noise on the right and left sides of the circles
+leftCutoff  = 50
+rightCutoff = 20
+
+
+#margin in original pixels kept around the circle template by FrameRoi.around,
+#giving the template search room for the cartridge moving a little
+roiMargin = 32
+
+
+class FrameRoi(object):
+  '''Rectangle of the camera frame holding the cartridge.
+
+  Images of just the rectangle are measured as if they were the whole frame,
+  so the circles are found at the same scale. x and y are multiples of
+  alignment(), which makes the pixels of the shrunk image the same as the
+  ones of the shrunk whole frame.
+
+  Attributes:
+    x, y, width, height: the rectangle in the frame
+    frameWidth, frameHeight: size of the whole frame
+  '''
+
+  def __init__(self, x, y, width, height, frameWidth, frameHeight):
+    self.x = x
+    self.y = y
+    self.width = width
+    self.height = height
+    self.frameWidth = frameWidth
+    self.frameHeight = frameHeight
+
+  @staticmethod
+  def whole(shape):
+    '''Get the rectangle of a whole frame of the given shape.'''
+    return FrameRoi(0, 0, shape[1], shape[0], shape[1], shape[0])
+
+  @staticmethod
+  def alignment(frameWidth):
+    '''Get the step in frame pixels between the pixels of the shrunk image.'''
+    return frameWidth // math.gcd(frameWidth, newWidth)
+
+  @staticmethod
+  def around(masks, roi):
+    '''Get the rectangle holding the circles and the template with a margin.
+
+    Args:
+      masks: SpotMasks found in an image of the rectangle roi
+      roi: FrameRoi of the image the masks were found in
+
+    Returns:
+      A FrameRoi of the same frame, aligned and inside the frame
+    '''
+    sizeRatio = float(newWidth)/roi.frameWidth
+    step = FrameRoi.alignment(roi.frameWidth)
+    templateHeight, templateWidth = next(iter(templateBank().values())).shape
+    circles = [(c, masks.radius) for c in masks.centers] + [(c, masks.bkgroundRadius) for c in masks.bkgroundCenters]
+    x0 = min(c[0] - r for c, r in circles) + roi.x
+    x1 = max(c[0] + r for c, r in circles) + roi.x
+    y0 = min(c[1] - r for c, r in circles) + roi.y
+    y1 = max(c[1] + r for c, r in circles) + roi.y
+    #the template search needs the whole template inside the image
+    halfWidth = max(x1 - x0, templateWidth / sizeRatio) / 2 + roiMargin
+    halfHeight = max(y1 - y0, templateHeight / sizeRatio) / 2 + roiMargin
+    cx = (x0 + x1) / 2
+    cy = (y0 + y1) / 2
+    left = max(int(cx - halfWidth) // step * step, 0)
+    top = max(int(cy - halfHeight) // step * step, 0)
+    right = min(-(-int(math.ceil(cx + halfWidth)) // step) * step, roi.frameWidth)
+    bottom = min(-(-int(math.ceil(cy + halfHeight)) // step) * step, roi.frameHeight)
+    return FrameRoi(left, top, right - left, bottom - top, roi.frameWidth, roi.frameHeight)
+
+  def crop(self, frame):
+    '''Get the rectangle of a whole frame as a view, without copying.'''
+    return frame[self.y:self.y+self.height, self.x:self.x+self.width]
+
+  def toDict(self):
+    '''Get the rectangle as a dict, ready for json.dump.'''
+    return {'x': self.x, 'y': self.y, 'width': self.width, 'height': self.height,
+            'frameWidth': self.frameWidth, 'frameHeight': self.frameHeight}
+
+  def __eq__(self, other):
+    return isinstance(other, FrameRoi) and self.toDict() == other.toDict()
+
+  def __ne__(self, other):
+    return not self == other
+
+
+def shrinkImage(imgOrig, roi=None):
+  '''Resize the image to newWidth and crop to get rid of the border noise.
+
+  With a FrameRoi the image is the rectangle of the frame, which is resized
+  and cropped as the whole frame would be.
+  '''
+  if roi is None:
+    roi = FrameRoi.whole(imgOrig.shape)
+  sizeRatio = float(newWidth)/roi.frameWidth
+  img = cv2.resize(imgOrig, (0,0), fx=sizeRatio, fy=sizeRatio)
+
+  #finalImgSmall = img.copy()
+  #grayImgSmall  = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+  shrunkX = int(round(roi.x * sizeRatio))
+  img = img[::,max(leftCutoff - shrunkX, 0):newWidth - rightCutoff - shrunkX,::]
+
+  if debugFlag:
+    cv2.imshow('Resized and Cropped Image', img)
+    cv2.waitKey()
+  return img
+
+
+#structuring element of the dilation used for the edge map
+edgeKernel = cv2.getStructuringElement(cv2.MORPH_RECT, (9, 9))
+
+def edgeMap(img, out=None):
+  '''Make the edge map of a colour image.
+
+  For every channel the image is subtracted from its 9x9 dilation, and the
+  largest of these differences over the channels is the edge value. All the
+  channels are dilated in one OpenCV call and the channel max is written
+  straight into out, which is allocated if None.
+  '''
+  dilated = cv2.dilate(img, edgeKernel)
+  cv2.subtract(dilated, img, dst=dilated)
+  if out is None:
+    out = np.empty(img.shape[:2], np.uint8)
+  np.max(dilated, axis=2, out=out)
+  return out
+
+
+def edgeMapReference(img):
+  '''The original scipy version of edgeMap, only kept to check against.'''
+  from scipy.ndimage import grey_dilation
+  bin = np.zeros([img.shape[0], img.shape[1]], dtype=np.uint8)
+  for i in cv2.split(img):
+    bin = np.maximum(bin, grey_dilation(i, (9, 9)) - i)
+  return bin
+
+
+def skeletonImage(img, edges=edgeMap):
+  '''Make the skeleton of the edge map of a shrunk image.
+
+  This is the image the circle template is matched against.
+  '''
+  img = cv2.bilateralFilter(img, 9, 9, 9)
+
+  if debugFlag:
+    cv2.imshow('Resized and Cropped Image After Filtering', img)
+    cv2.waitKey()
+
+  bin = edges(img)
+
+  #binarize the edge map
+  mean, std = bin.mean(), bin.std()
+  ret, bin = cv2.threshold(bin, mean + .3 * std, 255, cv2.THRESH_BINARY)
+
+  #skeleton image of edge map
+  skeletonImg = bin.copy()
+  skeletonImg[skeletonImg == 255] = 1
+  skel = skeletonize(skeletonImg)
+  skel = img_as_ubyte(skel)
+
+  if debugFlag:
+    cv2.imshow('Binary Image', bin)
+    cv2.imshow('Skeleton Image', skel)
+    cv2.waitKey()
+  return skel
+
+
+#rotations of the template tried when matching, in degrees from
+#-templateAngleRange to templateAngleRange in steps of templateAngleStep
+templateAngleRange = 10
+templateAngleStep = 2
+
+#rotated templates already made, keyed by (angle step, resize ratio)
+_templateBanks = {}
+
+def templateBank(angleStep=None, ratio=1.0):
+  '''Get the rotated versions of the circle template.
+
+  The rotations are only computed the first time a combination of angle step
+  and resize ratio is asked for, so a finer angle grid (e.g. 0.5 degrees) only
+  costs at startup.
+
+  Args:
+    angleStep: degrees between the rotations, templateAngleStep if None
+    ratio: factor to resize the template with before rotating it
+
+  Returns:
+    A dict of rotation angle -> template image, ordered by angle
+  '''
+  if angleStep is None:
+    angleStep = templateAngleStep
+  key = (angleStep, ratio)
+  if key not in _templateBanks:
+    templateOrig = cv2.imread(templatePath, 0)
+    if ratio != 1.0:
+      templateOrig = cv2.resize(templateOrig, (0,0), fx=ratio, fy=ratio, interpolation=cv2.INTER_AREA)
+    h, w = templateOrig.shape
+    bank = {}
+    for angle in np.arange(-templateAngleRange, templateAngleRange + angleStep/2.0, angleStep):
+      M = cv2.getRotationMatrix2D((w/2,h/2), -angle, 1)
+      bank[float(angle)] = cv2.warpAffine(templateOrig, M, (w, h))
+    _templateBanks[key] = bank
+  return _templateBanks[key]
+
+#build the default bank at import, so it is ready before the first image
+templateBank()
+
+#how the template is searched for in findCircles:
+#'exhaustive' matches every rotation over the whole skeleton image
+#'pyramid' matches every rotation on a shrunk skeleton image first, and then
+#only refines the position and angle around the best peak at full size
+templateSearchMode = 'exhaustive'
+
+#size of the shrunk image used for the first step of the pyramid search
+pyramidRatio = 0.5
+
+#pixels around the coarse peak searched at full size in the pyramid search
+pyramidMargin = 6
+
+
+def bestMatch(img, bank, angles=None):
+  '''Match the templates of a template bank against an image.
+
+  Args:
+    img: skeleton image to search in
+    bank: dict of angle -> template, as returned by templateBank
+    angles: the angles of the bank to try, all of them if None
+
+  Returns:
+    (score, angle, location of top left corner) of the best match
+  '''
+  bestScore, bestAngle, bestLoc = 0, None, None
+  for angle, template in bank.items():
+    if angles is not None and angle not in angles:
+      continue
+    res = cv2.matchTemplate(img, template, cv2.TM_CCOEFF_NORMED)
+    min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(res)
+    if debugFlag:
+      print(angle, min_val, max_val, min_loc, max_loc)
+    if max_val > bestScore:
+      bestScore, bestAngle, bestLoc = max_val, angle, max_loc
+  return bestScore, bestAngle, bestLoc
+
+
+def matchExhaustive(img, angleStep=None):
+  '''Find the template by trying every rotation over the whole image.'''
+  return bestMatch(img, templateBank(angleStep))
+
+
+def matchPyramid(img, angleStep=None):
+  '''Find the template coarse-to-fine.
+
+  All the rotations are matched on a shrunk version of the image. At full
+  size only the rotations next to the best coarse angle are tried, and only
+  in a small window around the coarse peak.
+  '''
+  if angleStep is None:
+    angleStep = templateAngleStep
+  small = cv2.resize(img, (0,0), fx=pyramidRatio, fy=pyramidRatio, interpolation=cv2.INTER_AREA)
+  score, angle, loc = bestMatch(small, templateBank(angleStep, pyramidRatio))
+  if loc is None:
+    return matchExhaustive(img, angleStep)
+
+  bank = templateBank(angleStep)
+  h, w = bank[angle].shape
+  imgHeight, imgWidth = img.shape[:2]
+  margin = pyramidMargin + int(math.ceil(1.0/pyramidRatio))
+  x0 = max(int(loc[0]/pyramidRatio) - margin, 0)
+  y0 = max(int(loc[1]/pyramidRatio) - margin, 0)
+  x1 = min(int(loc[0]/pyramidRatio) + margin + w, imgWidth)
+  y1 = min(int(loc[1]/pyramidRatio) + margin + h, imgHeight)
+  if x1 - x0 < w or y1 - y0 < h:
+    return matchExhaustive(img, angleStep)
+
+  neighbours = [a for a in bank if abs(a - angle) <= angleStep * 1.01]
+  score, angle, loc = bestMatch(img[y0:y1, x0:x1], bank, neighbours)
+  if loc is None:
+    return score, angle, loc
+  return score, angle, (loc[0] + x0, loc[1] + y0)
+
+
+def matchTemplate(img):
+  '''Find the circle template in a skeleton image using templateSearchMode.'''
+  if templateSearchMode == 'pyramid':
+    return matchPyramid(img)
+  return matchExhaustive(img)
+
+
+#percentiles of the pixel values reported for each spot besides the mean
+statPercentiles = (10, 25, 50, 75, 90)
+
+
+class SpotMasks(object):
+  '''Label image marking where the spots and the background circles are.
+
+  Only the bounding box around all the circles is stored, with pixels
+  labelled 0 for none, 1-5 for the spots and 6 for the background circles.
+  A pixel covered by both a spot and a background circle belongs to the spot.
+
+  Attributes:
+    labels: the label image of the bounding box
+    offset: (x, y) of the bounding box in the original image
+    centers: list (size 5) of (x, y) spot centres in the original image
+    radius: radius of the spots in the original image
+    bkgroundCenters: list (size 4) of (x, y) background circle centres
+    bkgroundRadius: radius of the background circles
+    score: template match score of the detection the masks came from
+    angle: rotation in degrees of the best matching template
+  '''
+
+  background = 6
+
+  def __init__(self, centers, radius, bkgroundCenters, bkgroundRadius, shape, score=None, angle=None):
+    self.centers = centers
+    self.radius = radius
+    self.bkgroundCenters = bkgroundCenters
+    self.bkgroundRadius = bkgroundRadius
+    self.score = score
+    self.angle = angle
+
+    circles = [(c, bkgroundRadius) for c in bkgroundCenters] + [(c, radius) for c in centers]
+    x0 = max(int(min(c[0] - r for c, r in circles)) - 1, 0)
+    y0 = max(int(min(c[1] - r for c, r in circles)) - 1, 0)
+    x1 = min(int(max(c[0] + r for c, r in circles)) + 2, shape[1])
+    y1 = min(int(max(c[1] + r for c, r in circles)) + 2, shape[0])
+    self.offset = (x0, y0)
+    self.labels = np.zeros((max(y1 - y0, 0), max(x1 - x0, 0)), np.uint8)
+
+    #circles are drawn with 4 bits of sub-pixel precision
+    shift = 4
+    for label, (c, r) in zip([self.background] * len(bkgroundCenters) + list(range(1, len(centers) + 1)), circles):
+      center = (int(round((c[0] - x0) * 16)), int(round((c[1] - y0) * 16)))
+      cv2.circle(self.labels, center, int(round(r * 16)), label, -1, cv2.LINE_8, shift)
+
+  def crop(self, img):
+    '''Get the part of an image of original size covered by the labels.'''
+    x0, y0 = self.offset
+    h, w = self.labels.shape
+    return img[y0:y0+h, x0:x0+w]
+
+  def boundingBox(self, label):
+    '''Get (x, y, w, h) in the original image of the pixels with a label.'''
+    ys, xs = np.nonzero(self.labels == label)
+    x0, y0 = self.offset
+    return (x0 + int(xs.min()), y0 + int(ys.min()), int(xs.max() - xs.min()) + 1, int(ys.max() - ys.min()) + 1)
+
+  def fullLabels(self, shape):
+    '''Get the label image at the full size of the original image.'''
+    full = np.zeros(shape[:2], np.uint8)
+    self.crop(full)[...] = self.labels
+    return full
+
+
+def labelStatistics(singleChannelImg, masks):
+  '''Get statistics of the pixel values for every label in a single pass.
+
+  Args:
+    singleChannelImg: image of original size to measure on
+    masks: SpotMasks telling where the spots and the background are
+
+  Returns:
+    A list indexed by label (0 is unused) of dicts with the count, mean,
+    std and the statPercentiles ('p50' is the median) of the pixels
+  '''
+  labels = masks.labels.ravel()
+  values = masks.crop(singleChannelImg).ravel().astype(np.float64)
+  numLabels = SpotMasks.background + 1
+  counts = np.bincount(labels, minlength=numLabels)
+  sums = np.bincount(labels, weights=values, minlength=numLabels)
+  squares = np.bincount(labels, weights=values * values, minlength=numLabels)
+
+  #sort the pixels by label and value, so every label is a sorted slice
+  sortedValues = values[np.lexsort((values, labels))]
+  starts = np.concatenate(([0], np.cumsum(counts)))
+
+  stats = [None]
+  for label in range(1, numLabels):
+    count = int(counts[label])
+    stat = {'count': count}
+    if count:
+      mean = sums[label] / count
+      stat['mean'] = float(mean)
+      stat['std'] = float(math.sqrt(max(squares[label] / count - mean * mean, 0.0)))
+      labelValues = sortedValues[starts[label]:starts[label + 1]]
+      for percentile, value in zip(statPercentiles, np.percentile(labelValues, statPercentiles)):
+        stat['p%d' % percentile] = float(value)
+    else:
+      stat['mean'] = 0.0
+    stats.append(stat)
+  return stats
+
+
+class SpotIntensities(object):
+  '''Result of detecting the five spots in a sample image.
+
+  Attributes:
+    intensities: list (size 5) of the average intensity of each spot
+    background: average intensity of the background circles
+    masks: SpotMasks with the location of the spots and the background
+    spotStats: list (size 5) of dicts with the mean, std and percentiles of
+      each spot, as returned by labelStatistics
+    backgroundStats: the same for the background circles
+    timings: dict of the seconds used by each stage of the detection
+    roi: FrameRoi of the frame the image covers, None for the whole frame.
+      The positions in masks are relative to the image
+  '''
+
+  def __init__(self, intensities, background, masks, stats, timings=None, roi=None):
+    self.intensities = intensities
+    self.background = background
+    self.masks = masks
+    self.spotStats = stats[1:SpotMasks.background]
+    self.backgroundStats = stats[SpotMasks.background]
+    self.timings = timings if timings is not None else {}
+    self.roi = roi
+
+  def toDict(self):
+    '''Get the result as a dict of plain types, ready for json.dump.'''
+    masks = self.masks
+    return {
+      'intensities': [float(i) for i in self.intensities],
+      'background': float(self.background),
+      'spotStats': self.spotStats,
+      'backgroundStats': self.backgroundStats,
+      'score': None if masks.score is None else float(masks.score),
+      'angle': None if masks.angle is None else float(masks.angle),
+      'centers': [[float(x), float(y)] for x, y in masks.centers],
+      'radius': float(masks.radius),
+      'bkgroundCenters': [[float(x), float(y)] for x, y in masks.bkgroundCenters],
+      'bkgroundRadius': float(masks.bkgroundRadius),
+      'timings': self.timings,
+      'roi': None if self.roi is None else self.roi.toDict(),
+    }
+
+
+def writeResult(detected, filename):
+  '''Write a SpotIntensities as one JSON record.
+
+  The record is written to a temporary file first and then renamed, so a
+  reader never sees a half written file.
+  '''
+  tmpName = filename + '.tmp'
+  with open(tmpName, 'w') as f:
+    json.dump(detected.toDict(), f, indent=2)
+  os.replace(tmpName, filename)
+
+
+def detect(imgOrig, sampleType='', masks=None, roi=None):
+  '''Find the spots in an image and measure their intensities.
+
+  Args:
+    imgOrig: BGR image as a numpy array
+    sampleType: type used to select the channel to measure on. The default
+      measures on the inverted gray image, as used for production samples
+    masks: SpotMasks from an earlier detection on the same cartridge. If
+      given, the circle detection is skipped
+    roi: FrameRoi if the image is only a rectangle of the camera frame
+
+  Returns:
+    A SpotIntensities object
+  '''
+  timings = {}
+  start = time.time()
+  result = findCircles(imgOrig, sampleType, masks, timings, roi)
+  timings['total'] = time.time() - start
+  return SpotIntensities(*result, timings=timings, roi=roi)
+
+
+#width the images are shrunk to before estimating how much the cartridge moved
+driftImageWidth = 160
+
+def driftImage(imgOrig):
+  '''Make a small edge image of a sample image used to measure movement.
+
+  The edges are used instead of the intensities, as the images compared are
+  often taken with different light colours.
+  '''
+  ratio = float(driftImageWidth)/imgOrig.shape[1]
+  gray = cv2.cvtColor(imgOrig, cv2.COLOR_BGR2GRAY)
+  gray = cv2.resize(gray, (0,0), fx=ratio, fy=ratio, interpolation=cv2.INTER_AREA)
+  gray = cv2.GaussianBlur(gray, (3, 3), 0).astype(np.float32)
+  edges = cv2.magnitude(cv2.Sobel(gray, cv2.CV_32F, 1, 0), cv2.Sobel(gray, cv2.CV_32F, 0, 1))
+  edges /= max(float(edges.max()), 1.0)
+  return edges
+
+
+def imageDrift(reference, edges, imgOrigWidth):
+  '''Estimate how far the image has moved from the reference, measured in
+  pixels of the original image.'''
+  window = cv2.createHanningWindow(reference.shape[::-1], cv2.CV_32F)
+  (dx, dy), response = cv2.phaseCorrelate(reference, edges, window)
+  return math.hypot(dx, dy) * imgOrigWidth / float(driftImageWidth)
+
+
+class MaskCache(object):
+  '''Keeps the circle masks of a cartridge between the images of one analysis.
+
+  The first image detects the circles from scratch. The following images
+  reuse the masks unless the cartridge has moved more than driftLimit pixels
+  since the masks were made, in which case the circles are detected again.
+  A driftLimit of None disables the reuse.
+  '''
+
+  def __init__(self, driftLimit=4.0):
+    self.driftLimit = driftLimit
+    self.masks = None
+    self.reference = None
+
+  def detect(self, imgOrig, sampleType='', roi=None):
+    '''Same as the detect function, but reusing the cached masks if possible.'''
+    edges = None
+    if self.driftLimit is not None:
+      edges = driftImage(imgOrig)
+      if self.masks is not None and edges.shape == self.reference.shape:
+        drift = imageDrift(self.reference, edges, imgOrig.shape[1])
+        if drift <= self.driftLimit:
+          print("Reusing circle masks, cartridge moved %.1f pixels" % drift)
+          return detect(imgOrig, sampleType, self.masks, roi)
+        print("Cartridge moved %.1f pixels, detecting circles again" % drift)
+
+    detected = detect(imgOrig, sampleType, roi=roi)
+    self.masks = detected.masks
+    self.reference = edges
+    return detected
+
+
+def _lap(timings, stage, start):
+  '''Store the seconds since start as the time of a stage, if timings is a
+  dict, and return the current time to start the next stage from.'''
+  now = time.time()
+  if timings is not None:
+    timings[stage] = now - start
+  return now
+
+
 #find the 5 circles in the image
-def findCircles(imgOrig, sampleType, circleBinList=None, bkgroundCircles=None):
+#if timings is a dict, the seconds used by each stage are stored in it
+#if roi is a FrameRoi, the image is that rectangle of the camera frame
+def findCircles(imgOrig, sampleType, masks=None, timings=None, roi=None):
+  lap = time.time()
   imgOrigHeight, imgOrigWidth = imgOrig.shape[:2]
   print("Original Image height & width:", imgOrigHeight, imgOrigWidth)
 
@@ -75,16 +644,13 @@ def findCircles(imgOrig, sampleType, circleBinList=None, bkgroundCircles=None):
       cv2.imshow('Original Image (displayed to fit on screen)', imgOrig)
       cv2.waitKey()
 
-  returnMasks = False
-
   if debugFlag:
     finalDisplayImg = imgOrig.copy()
 
   #############################################################################
   #Compute circle masks from scratch if they weren't passed in
   #############################################################################
-  if circleBinList == None:
-    returnMasks = True
+  if masks is None:
 
     #Note that these three values were given by Keenan as contants and will
     #need to be updated if the image sizes are ever updated
@@ -94,121 +660,51 @@ def findCircles(imgOrig, sampleType, circleBinList=None, bkgroundCircles=None):
 
     templateCirclesMeasurementRadius = 208*0.25
 
-    #used as the size to shrink the images down to (makes detecting circles and
-    #other computations faster)
-    newWidth    = 360
-
-    #used to crop out the noise on the right and left sides of the circles
-    leftCutoff  = 50
-    rightCutoff = 20
-
     #approximate location in the shrunk, cropped images where we are
     #looking for the circle centers
     defaultCenters = [(141, 52), (210, 95), (189, 171), (92, 172), (70, 94)]
     #circlesFound   = [False, False, False, False, False]
 
-    sizeRatio   = float(newWidth)/imgOrigWidth
+    if roi is None:
+      roi = FrameRoi.whole(imgOrig.shape)
+    sizeRatio   = float(newWidth)/roi.frameWidth
     circleRadiusRangeMin             *= sizeRatio
     circleRadiusRangeMax             *= sizeRatio
     detectedCirclesMeasurementRadius *= sizeRatio
 
-    #resize and crop to get rid of the border noise
-    img = cv2.resize(imgOrig, (0,0), fx=sizeRatio, fy=sizeRatio)
-
-    #finalImgSmall = img.copy()
-    #grayImgSmall  = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
-    img = img[::,leftCutoff:newWidth - rightCutoff,::]
+    img = shrinkImage(imgOrig, roi)
+    lap = _lap(timings, 'shrink', lap)
 
     imgHeight, imgWidth = img.shape[:2]
+    #where the image is in the shrunk and cropped whole frame
+    shiftX = max(int(round(roi.x * sizeRatio)) - leftCutoff, 0)
+    shiftY = int(round(roi.y * sizeRatio))
+    frameHeight = int(round(roi.frameHeight * sizeRatio))
     print("Resized Cropped Image height & width:", imgHeight, imgWidth)
 
     print("Size ratio:", sizeRatio)
 
-    if debugFlag:
-      cv2.imshow('Resized and Cropped Image', img)
-      cv2.waitKey()
-
-    img = cv2.bilateralFilter(img, 9, 9, 9)
-
-    if debugFlag:
-      cv2.imshow('Resized and Cropped Image After Filtering', img)
-      cv2.waitKey()
-
-    bin = np.zeros([img.shape[0], img.shape[1]], dtype=np.uint8)
-    im  = bin.copy()
-    for i in cv2.split(img):
-      #Inner morphological gradient.
-      im = np.maximum(im, morphology.grey_dilation(i, (9, 9)) - i)
-      im.reshape(img.shape[0], img.shape[1])
-      mean, std = im.mean(), im.std()
-      bin = np.maximum(bin, im)
-      bin.reshape(img.shape[0], img.shape[1])
-
-    #binarize the edge map
-    mean, std = bin.mean(), bin.std()
-    ret, bin = cv2.threshold(bin, mean + .3 * std, 255, cv2.THRESH_BINARY)
-
-    #skeleton image of edge map
-    skeletonImg = bin.copy()
-    skeletonImg[skeletonImg == 255] = 1
-    skel = skeletonize(skeletonImg)
-    skel = img_as_ubyte(skel)
-
-    if debugFlag:
-      cv2.imshow('Binary Image', bin)
-      cv2.imshow('Skeleton Image', skel)
-      cv2.waitKey()
-
+    skel = skeletonImage(img)
+    lap = _lap(timings, 'skeleton', lap)
 
     #use the skeleton image to template match on
-    img =  skel.copy()
-    img2 = img.copy()
-    templateOrig = cv2.imread('circleBinTemplate.png',0)
-    w, h = templateOrig.shape[::-1]
-
-    bestScore = 0
     bestTemplate = np.zeros((imgHeight,imgWidth), np.uint8)
+    bestScore, bestAngle, bestLoc = matchTemplate(skel)
+    lap = _lap(timings, 'match', lap)
+    if bestLoc is not None:
+        template = templateBank()[bestAngle]
+        h, w = template.shape
+        bestTemplate[bestLoc[1]:bestLoc[1]+h, bestLoc[0]:bestLoc[0]+w] += template
+        print("Template match score %f at angle %.1f" % (bestScore, bestAngle))
+    if debugFlag:
+        cv2.imshow('Best Template', bestTemplate)
+        cv2.waitKey()
 
-    #cycle through tempate rotations from -10 to 10 degrees and get the best match
-    method = cv2.TM_CCOEFF_NORMED
-    for i in range(-10, 11, 2):
-        img = img2.copy()
-
-        M = cv2.getRotationMatrix2D((w/2,h/2), -i, 1)
-        template = cv2.warpAffine(templateOrig, M, (w, h))
-
-        # Apply template Matching
-        res = cv2.matchTemplate(img, template, method)
-        min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(res)
-
-        top_left = max_loc
-        bottom_right = (top_left[0] + w, top_left[1] + h)
-
-        cv2.rectangle(img,top_left, bottom_right, 255, 2)
-
-        if max_val > bestScore:
-            bestScore = max_val
-            bestTemplate = np.zeros((imgHeight,imgWidth), np.uint8)
-            bestTemplate[max_loc[1]:max_loc[1]+h, max_loc[0]:max_loc[0]+w] += template
-        if debugFlag:
-            print(min_val, max_val, min_loc, max_loc)
-            cv2.imshow('Template Image ', template)
-            cv2.imshow('Matched Image ', img)
-            img[max_loc[1]:max_loc[1]+h, max_loc[0]:max_loc[0]+w] += template
-            cv2.imshow('Matched Image2 ', img)
-            cv2.imshow('Best Template', bestTemplate)
-            cv2.waitKey()
-
-
-    #array to hold each individual circle image
-    circleBinList = []
-
-    circleBin       = np.zeros((imgHeight,imgWidth), np.uint8)
-    bkgroundCircles = np.zeros((imgHeight,imgWidth), np.uint8)
+    #centres of each individual circle
+    centers = []
 
     #go through each of the five contours in the template and get the centroids,
-    #storing the resulting circle in the appropriate circleBin variables
+    #storing the resulting circle centres in order
     avgx = 0
     avgy = 0
 
@@ -222,29 +718,25 @@ def findCircles(imgOrig, sampleType, circleBinList=None, bkgroundCircles=None):
     cnts = cnts[cntsNum]
     for c in cnts:
         M = cv2.moments(c)
-        cX = int(M["m10"] / M["m00"])
-        cY = int(M["m01"] / M["m00"])
+        cX = int(M["m10"] / M["m00"]) + shiftX
+        cY = int(M["m01"] / M["m00"]) + shiftY
         print(cX, cY)
         avgx += cX
         avgy += cY
 
-        newCircle = np.zeros((imgHeight,imgWidth), np.uint8)
-        cv2.circle(newCircle, (cX, cY), int(detectedCirclesMeasurementRadius), 255, -1)
-        circleBin = cv2.bitwise_or(circleBin, newCircle)
-
         #looking at the bottom two circles, we want the one on the right to
         #be first
-        if len(circleBinList) == 1 and lastX < cX:
-                circleBinList.insert(0, newCircle.copy())
+        if len(centers) == 1 and lastX < cX:
+                centers.insert(0, (cX, cY))
         #looking at the middle two circles, we want the one on the right to be
         #first overall
-        elif (len(circleBinList) == 2 or len(circleBinList) == 3) and lastX < cX:
-                circleBinList.insert(0, newCircle.copy())
+        elif (len(centers) == 2 or len(centers) == 3) and lastX < cX:
+                centers.insert(0, (cX, cY))
         #the one closest to the top should be the first one in the sequence
-        elif len(circleBinList) == 4:
-                circleBinList.insert(0, newCircle.copy())
+        elif len(centers) == 4:
+                centers.insert(0, (cX, cY))
         else:
-           circleBinList.append(newCircle.copy())
+           centers.append((cX, cY))
 
         lastX = cX
         lastY = cY
@@ -257,42 +749,35 @@ def findCircles(imgOrig, sampleType, circleBinList=None, bkgroundCircles=None):
     #print("(False = Circles that Hough couldn't find, which will be drawn with default coordinates)")
 
     #print("DEBUG - center average:", avgx, avgy)
-    #draw the center background circle
-    cv2.circle(bkgroundCircles, (avgx, avgy), int(detectedCirclesMeasurementRadius * .8), 255, -1)
-
     #find the distance of where the bottom-most background circle should go
-    dist = imgHeight - int(detectedCirclesMeasurementRadius * 1.25) - avgy
+    dist = frameHeight - int(detectedCirclesMeasurementRadius * 1.25) - avgy
 
     #pythagorean theorem to find the x/y 45 degree distance for the other two
     #background circles
     pyth_dist = int(math.sqrt( dist * dist / 2 ))
 
-    #draw the bottom background circle
-    cv2.circle(bkgroundCircles, (avgx, avgy + dist), int(detectedCirclesMeasurementRadius * .8), 255, -1)
-    #draw the upper left background circle
-    cv2.circle(bkgroundCircles, (avgx - pyth_dist, avgy - pyth_dist), int(detectedCirclesMeasurementRadius * .8), 255, -1)
-    #draw the upper right background circle
-    cv2.circle(bkgroundCircles, (avgx + pyth_dist, avgy - pyth_dist), int(detectedCirclesMeasurementRadius * .8), 255, -1)
+    #the center, bottom, upper left and upper right background circles
+    bkgroundCenters = [(avgx, avgy), (avgx, avgy + dist),
+                       (avgx - pyth_dist, avgy - pyth_dist), (avgx + pyth_dist, avgy - pyth_dist)]
 
-    #add back what was cropped off and resize to original size
-    circleBin = cv2.copyMakeBorder(circleBin, 0, 0, leftCutoff, rightCutoff, cv2.BORDER_CONSTANT)
-    circleBin = cv2.resize(circleBin, (imgOrigWidth, imgOrigHeight))
+    #add back what was cropped off and scale the circles to original size,
+    #relative to the image given. The radius gets half a pixel extra, as the
+    #circles used to be drawn at the small size and scaled up
+    def toOrig(center):
+      return ((center[0] + leftCutoff + 0.5) / sizeRatio - 0.5 - roi.x,
+              (center[1] + 0.5) / sizeRatio - 0.5 - roi.y)
 
-    #add back what was cropped off and resize to original size
-    bkgroundCircles = cv2.copyMakeBorder(bkgroundCircles, 0, 0, leftCutoff, rightCutoff, cv2.BORDER_CONSTANT)
-    bkgroundCircles = cv2.resize(bkgroundCircles, (imgOrigWidth, imgOrigHeight))
+    masks = SpotMasks([toOrig(c) for c in centers],
+                      (int(detectedCirclesMeasurementRadius) + 0.5) / sizeRatio,
+                      [toOrig(c) for c in bkgroundCenters],
+                      (int(detectedCirclesMeasurementRadius * .8) + 0.5) / sizeRatio,
+                      imgOrig.shape, bestScore, bestAngle)
+    lap = _lap(timings, 'masks', lap)
 
     if debugFlag:
-      cv2.namedWindow('circleBinList Item (displayed to fit on screen)', cv2.WINDOW_NORMAL)
-
-    #add back what was cropped off and resize to original size (do for each circle)
-    for i in range(0, len(circleBinList)):
-      circleBinList[i] = cv2.copyMakeBorder(circleBinList[i],0,0,leftCutoff,rightCutoff,cv2.BORDER_CONSTANT)
-      circleBinList[i] = cv2.resize(circleBinList[i], (imgOrigWidth, imgOrigHeight))
-
-      if debugFlag:
-        cv2.imshow('circleBinList Item (displayed to fit on screen)', circleBinList[i])
-        cv2.waitKey()
+      cv2.namedWindow('Spot labels (displayed to fit on screen)', cv2.WINDOW_NORMAL)
+      cv2.imshow('Spot labels (displayed to fit on screen)', masks.labels * 40)
+      cv2.waitKey()
   #end compute circles from scratch
   #############################################################################
 
@@ -338,23 +823,27 @@ def findCircles(imgOrig, sampleType, circleBinList=None, bkgroundCircles=None):
 
   imgSingleChannelHeight, imgSingleChannelWidth = imgOrig.shape[:2]
   print("Single Channel Image height & width:", imgSingleChannelHeight, imgSingleChannelWidth)
+  lap = _lap(timings, 'channel', lap)
 
-  bkgroundIntensityAvg = cv2.mean(singleChannelImg, bkgroundCircles)[0]
-  print("Average intensity for background circles: ", bkgroundIntensityAvg)
+  #measure all the spots and the background in one pass over the labels
+  stats = labelStatistics(singleChannelImg, masks)
+  lap = _lap(timings, 'measure', lap)
 
-  if debugFlag:
-    circleBin = np.zeros((imgOrigHeight,imgOrigWidth), np.uint8)
+  bkgroundIntensityAvg = stats[SpotMasks.background]['mean']
+  print("Average intensity for background circles: ", bkgroundIntensityAvg)
 
   intensityAverages = []
   #for each circle, get it's average graylevel intensity.
   #Store in 'averages' list for later use
-  for i in range(0, len(circleBinList)):
-    avg = cv2.mean(singleChannelImg, circleBinList[i])[0]
+  for i in range(0, len(masks.centers)):
+    avg = stats[i + 1]['mean']
     print("Average intensity for circle " + str(i + 1) + ": ", avg)
     intensityAverages.append(avg)
 
-    if debugFlag:
-      circleBin = cv2.bitwise_or(circleBin, circleBinList[i])
+  if debugFlag:
+    fullLabels = masks.fullLabels(imgOrig.shape)
+    circleBin = np.where((fullLabels > 0) & (fullLabels < SpotMasks.background), 255, 0).astype(np.uint8)
+    bkgroundCircles = np.where(fullLabels == SpotMasks.background, 255, 0).astype(np.uint8)
 
   #Final debugging visuals
   if debugFlag:
@@ -385,30 +874,18 @@ def findCircles(imgOrig, sampleType, circleBinList=None, bkgroundCircles=None):
   #return:
   #1) an array (size 5) of average intensity values for each circle
   #2) the average intensity value of the 4 background circles
-  #3) an array (size 5) of masks for each of the five detected circles (clockwise ordering)
-  #4) a mask containing the four background circles
-
-  if returnMasks == True:
-    return intensityAverages, bkgroundIntensityAvg, circleBinList, bkgroundCircles
-  else:
-      #3) and 4) are not returned if they are already known and used
-      #as input into this function
-      return intensityAverages, bkgroundIntensityAvg
+  #3) SpotMasks with the five detected circles (clockwise ordering) and the
+  #   four background circles
+  #4) statistics for every label, as returned by labelStatistics
+  return intensityAverages, bkgroundIntensityAvg, masks, stats
 
 
-def writeCirclesToFiles(imgOrig, circleBinList, sampleTypeUniqueName):
+def writeCirclesToFiles(imgOrig, masks, sampleTypeUniqueName):
   shrinkAmt = trainingMode_SquareRadiusShrink
 
   print("Sample type unique id for training mode: " + sampleTypeUniqueName)
-  circleNum = 1
-  for circleImg in circleBinList:
-    #this detects contours from bottom to top of image
-    cnts = cv2.findContours(circleImg.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    #IMPORTANT! different versions of OpenCV have different return order in
-    # findContours. Change this to cnts[1] if this step is not working
-    cnts = cnts[cntsNum]
-    for cnt in cnts:
-      x, y, w, h = cv2.boundingRect(cnt)
+  for circleNum in range(1, len(masks.centers) + 1):
+    x, y, w, h = masks.boundingBox(circleNum)
 
     print(x, y, w, h)
     circleCutoutFromOrig = imgOrig[y+shrinkAmt:y+h-shrinkAmt, x+shrinkAmt:x+w-shrinkAmt]
@@ -417,16 +894,157 @@ def writeCirclesToFiles(imgOrig, circleBinList, sampleTypeUniqueName):
     if debugFlag:
       cv2.namedWindow('Circle Cut Out From Original', cv2.WINDOW_NORMAL)
       cv2.imshow('Circle Cut Out From Original', circleCutoutFromOrig)
-
-      cv2.namedWindow('Circle Bin Image (displayed to fit on screen)', cv2.WINDOW_NORMAL)
-      cv2.imshow('Circle Bin Image (displayed to fit on screen)', circleImg)
       cv2.waitKey()
 
-    circleNum += 1
+
+def benchmarkSearch(folder, repeats=5):
+  '''Compare the exhaustive and the pyramid template search.
+
+  Runs both searches on the skeleton of every PNG image in the folder and
+  prints the time each takes per image and whether they agree on the
+  position and angle of the template.
+  '''
+  files = sorted(glob(os.path.join(folder, '*.png')))
+  timeExhaustive = 0.0
+  timePyramid = 0.0
+  agreeing = 0
+  print("image, exhaustive ms, pyramid ms, exhaustive angle, pyramid angle, distance px, agree")
+  for f in files:
+    skel = skeletonImage(shrinkImage(cv2.imread(f)))
+    results = []
+    for search in (matchExhaustive, matchPyramid):
+      start = time.time()
+      for i in range(repeats):
+        score, angle, loc = search(skel)
+      results.append((1000.0 * (time.time() - start) / repeats, angle, loc))
+    (tE, angleE, locE), (tP, angleP, locP) = results
+    distance = math.hypot(locE[0] - locP[0], locE[1] - locP[1])
+    agree = angleE == angleP and distance <= 2
+    timeExhaustive += tE
+    timePyramid += tP
+    agreeing += agree
+    print("%s, %.1f, %.1f, %.1f, %.1f, %.1f, %s" % (os.path.basename(f), tE, tP, angleE, angleP, distance, agree))
+  if files:
+    print("Mean time per image: exhaustive %.1f ms, pyramid %.1f ms" % (timeExhaustive / len(files), timePyramid / len(files)))
+    print("Agreement: %d of %d images" % (agreeing, len(files)))
+
+
+def benchmarkEdgeMap(folder, repeats=20):
+  '''Check edgeMap against the original scipy version.
+
+  For every PNG image in the folder it prints the time of both edge map
+  stages and whether the binarised skeletons they lead to are identical.
+  '''
+  files = sorted(glob(os.path.join(folder, '*.png')))
+  timeFused = 0.0
+  timeReference = 0.0
+  identical = 0
+  print("image, fused ms, scipy ms, identical skeleton")
+  for f in files:
+    img = shrinkImage(cv2.imread(f))
+    filtered = cv2.bilateralFilter(img, 9, 9, 9)
+    out = np.empty(filtered.shape[:2], np.uint8)
+    times = []
+    for stage in (lambda: edgeMap(filtered, out), lambda: edgeMapReference(filtered)):
+      start = time.time()
+      for i in range(repeats):
+        stage()
+      times.append(1000.0 * (time.time() - start) / repeats)
+    same = np.array_equal(skeletonImage(img), skeletonImage(img, edgeMapReference))
+    timeFused += times[0]
+    timeReference += times[1]
+    identical += same
+    print("%s, %.2f, %.2f, %s" % (os.path.basename(f), times[0], times[1], same))
+  if files:
+    print("Mean time per image: fused %.2f ms, scipy %.2f ms" % (timeFused / len(files), timeReference / len(files)))
+    print("Identical skeletons: %d of %d images" % (identical, len(files)))
+  return identical == len(files)
+
+
+#columns of the CSV file written in batch mode
+batchColumns = ['filename', 'spot1', 'spot2', 'spot3', 'spot4', 'spot5',
+                'background', 'score', 'angle', 'seconds', 'error']
+
+def _batchInit():
+  #every worker process gets one core, so don't let OpenCV start threads too,
+  #and keep the detection output out of the batch output
+  cv2.setNumThreads(1)
+  sys.stdout = open(os.devnull, 'w')
+
+
+def _batchDetectFile(filename):
+  '''Detect the spots of one image file and return a row for the batch CSV.'''
+  start = time.time()
+  try:
+    img = cv2.imread(filename)
+    if img is None:
+      raise IOError("Could not read image")
+    detected = detect(img)
+    row = [filename] + ['%f' % i for i in detected.intensities]
+    row += ['%f' % detected.background, '%f' % detected.masks.score, '%.1f' % detected.masks.angle]
+    error = ''
+  except Exception as e:
+    row = [filename] + [''] * 8
+    error = repr(e)
+  return row + ['%.3f' % (time.time() - start), error]
+
+
+def batchDetect(folder, outputFile=None, processes=None):
+  '''Detect the spots in every PNG image of a folder using a process pool.
+
+  The results are appended to a CSV file (batchColumns) as each image is
+  done, so an interrupted run can be resumed by running it again: images
+  already listed in the file are skipped.
+
+  Args:
+    folder: folder with the images, e.g. raw_images or /data/images
+    outputFile: CSV file, newdetect_batch.csv in the folder if None
+    processes: number of worker processes, one per core if None
+  '''
+  if outputFile is None:
+    outputFile = os.path.join(folder, 'newdetect_batch.csv')
+
+  done = set()
+  if os.path.exists(outputFile):
+    with open(outputFile, 'r', newline='') as infile:
+      for row in csv.DictReader(infile):
+        done.add(row['filename'])
+  files = [f for f in sorted(glob(os.path.join(folder, '*.png'))) if f not in done]
+  print("%d images to detect, %d already done" % (len(files), len(done)))
+
+  start = time.time()
+  pool = multiprocessing.Pool(processes or multiprocessing.cpu_count(), _batchInit)
+  try:
+    with open(outputFile, 'a', newline='') as outfile:
+      writer = csv.writer(outfile)
+      if outfile.tell() == 0:
+        writer.writerow(batchColumns)
+      for count, row in enumerate(pool.imap_unordered(_batchDetectFile, files), 1):
+        writer.writerow(row)
+        outfile.flush()
+        if row[-1]:
+          print("%s failed: %s" % (row[0], row[-1]))
+        print("%d/%d %s" % (count, len(files), os.path.basename(row[0])))
+  finally:
+    pool.terminate()
+    pool.join()
+  print("Detected %d images in %.1f seconds" % (len(files), time.time() - start))
+
 
 #example usage: python detectCircles.py [calibrate or operational] images/imgsamples/imgsamples/standards/originals/Pot.png images/imgsamples/imgsamples/standards/originals/Phos.png images/imgsamples/imgsamples/standards/originals/Nitra.png images/imgsamples/imgsamples/standards/originals/Ammo.png
 if __name__== "__main__":
 
+  if len(sys.argv) in (3, 4) and sys.argv[1] == 'batch':
+    batchDetect(sys.argv[2], sys.argv[3] if len(sys.argv) == 4 else None)
+    sys.exit(0)
+
+  if len(sys.argv) == 3 and sys.argv[1] == 'benchmark':
+    benchmarkSearch(sys.argv[2])
+    sys.exit(0)
+
+  if len(sys.argv) == 3 and sys.argv[1] == 'edgecheck':
+    sys.exit(0 if benchmarkEdgeMap(sys.argv[2]) else 1)
+
   if len(sys.argv) < 2:
     print("Not enough arguments!")
   elif len(sys.argv) != 2 and len(sys.argv) != 3 and len(sys.argv) != 6:
@@ -438,6 +1056,12 @@ if __name__== "__main__":
     print("python detectCircles.py operational Pot.png Phos.png Nitra.png Ammo.png")
     print("OR")
     print("python detectCircles.py training Nitra.png")
+    print("OR")
+    print("python detectCircles.py batch imageFolder [results.csv]")
+    print("OR")
+    print("python detectCircles.py benchmark imageFolder")
+    print("OR")
+    print("python detectCircles.py edgecheck imageFolder")
     sys.exit(1)
 
 
@@ -466,7 +1090,9 @@ if __name__== "__main__":
 
   print('\nInput File: ', str(inputFile))
   imgOrig = cv2.imread(str(inputFile))
-  intensityAverages, bkgroundIntensityAvg, circleBinList, bkgroundCircles = findCircles(imgOrig, sampleType)
+  timings = {}
+  intensityAverages, bkgroundIntensityAvg, masks, stats = findCircles(imgOrig, sampleType, timings=timings)
+  detected = SpotIntensities(intensityAverages, bkgroundIntensityAvg, masks, stats, timings)
 
   if modeType == 'lab':
     #Add an output text file for "lab" mode with specs provided by Keenan
@@ -484,6 +1110,8 @@ if __name__== "__main__":
     g.write("Background Average: %f" %bkgroundIntensityAvg)
     g.write("\n")
     g.close()
+    #the same result with the circles, statistics and timings as one record
+    writeResult(detected, sampleType + "_results_" + str(time.time()) + ".json")
 
   if modeType == 'training':
     trainingResultsFolder = fileFolder + "/training_results/"
@@ -505,8 +1133,9 @@ if __name__== "__main__":
     g.write(sampleTypeUniqueName + "_5,%f" %intensityAverages[4])
     g.write("\n")
     g.close()
+    writeResult(detected, sampleTypeUniqueName + ".json")
 
-    writeCirclesToFiles(imgOrig, circleBinList, sampleTypeUniqueName)
+    writeCirclesToFiles(imgOrig, masks, sampleTypeUniqueName)
 
   #keep consistent with Keenan's variable names:
   ck_avg = bkgroundIntensityAvg #potassium background circles avg
@@ -518,7 +1147,7 @@ if __name__== "__main__":
     sampleType = inputFile[inputFile.rfind('/') + 1:inputFile.rfind('.')].upper()
     print('\nInput File: ', str(inputFile))
     imgOrig = cv2.imread(str(inputFile))
-    intensityAverages, bkgroundIntensityAvg = findCircles(imgOrig, sampleType, circleBinList, bkgroundCircles)
+    intensityAverages, bkgroundIntensityAvg, masks, stats = findCircles(imgOrig, sampleType, masks)
 
     #keep consistent with Keenan's variable names:
     cp_avg = bkgroundIntensityAvg #phosphate background circles avg
@@ -529,7 +1158,7 @@ if __name__== "__main__":
     sampleType = inputFile[inputFile.rfind('/') + 1:inputFile.rfind('.')].upper()
     print('\nInput File: ', str(inputFile))
     imgOrig = cv2.imread(str(inputFile))
-    intensityAverages, bkgroundIntensityAvg = findCircles(imgOrig, sampleType, circleBinList, bkgroundCircles)
+    intensityAverages, bkgroundIntensityAvg, masks, stats = findCircles(imgOrig, sampleType, masks)
 
     #keep consistent with Keenan's variable names:
     cn_avg = bkgroundIntensityAvg   #nitrate background circles avg
@@ -540,7 +1169,7 @@ if __name__== "__main__":
     sampleType = inputFile[inputFile.rfind('/') + 1:inputFile.rfind('.')].upper()
     print('\nInput File: ', str(inputFile))
     imgOrig = cv2.imread(str(inputFile))
-    intensityAverages, bkgroundIntensityAvg = findCircles(imgOrig, sampleType, circleBinList, bkgroundCircles)
+    intensityAverages, bkgroundIntensityAvg, masks, stats = findCircles(imgOrig, sampleType, masks)
 
     #keep consistent with Keenan's variable names:
     ca_avg = bkgroundIntensityAvg  #ammonia background circles avg
@@ -7,56 +7,114 @@ __copyright__ = "Copyright (C) 2020 Nordetect"
 import analyseconfig
 
 import sys
-from subprocess import run, PIPE
 import os.path
-#import numpy as np
+from os import makedirs
+from time import time, monotonic
+import numpy as np
+import cv2
 #from PIL import Image
 #import pandas as pd
 from typing import Optional, List
 
+# Importing newdetect pulls in OpenCV, scikit-image and scipy, so we do it
+# once here instead of in every analysis.
+import newdetect
+import tracing
 from predictor import Predictor
 from utils import create_default_results, Results
 
 
-def cut(filepath: str) -> None:
-    # Process files in folder
-    print("Running newdetect.py in subprocess")
-    # Until newdetect get fixed, we need to run it from the dir it is in.
-    newdetect_path = os.path.join(analyseconfig.app_dir, 'newdetect')
-    res = run(["python3", 'newdetect.py', 'training', filepath],
-              cwd=newdetect_path, stdout=PIPE, stderr=PIPE)
-    if res.stdout:
-        print(res.stdout.decode("utf-8", "replace"))
-    if res.stderr:
-        print(res.stderr.decode("utf-8", "replace"), file=sys.stderr)
-    res.check_returncode()
+def cut(image: np.ndarray, filepath: str,
+        mask_cache: Optional[newdetect.MaskCache] = None,
+        roi: Optional[newdetect.FrameRoi] = None) -> newdetect.SpotIntensities:
+    """Find the spots in a sample image and measure their intensities.
+
+    The detection result is stored as one JSON record next to the image
+    file, named like the image with a .newdetect.json extension. If
+    analyseconfig.store_spot_cutouts is set, the cutouts of the spots are
+    stored in a training_results dir next to the image file for debugging.
+
+    Parameters:
+        image: The sample image as a BGR numpy array.
+        filepath: Path of the sample image file.
+        mask_cache: Circle masks shared between the images of one sample.
+            If None, the circles are always detected from scratch.
+        roi: The part of the camera frame the image covers. None if the
+            image is the whole frame.
+    Returns:
+        The intensities found by newdetect.
+
+    """
+    print("Running newdetect")
+    start = monotonic()
+    if mask_cache is None:
+        detected = newdetect.detect(image, roi=roi)
+    else:
+        detected = mask_cache.detect(image, roi=roi)
+    # The newdetect stages run one after the other in the order timed
+    for stage, seconds in detected.timings.items():
+        if stage != "total":
+            tracing.add_span("newdetect." + stage, seconds, start)
+            start += seconds
+    newdetect.writeResult(detected, os.path.splitext(filepath)[0] + ".newdetect.json")
+    if analyseconfig.store_spot_cutouts:
+        write_cutouts(image, filepath, detected)
+    return detected
+
+
+def write_cutouts(image: np.ndarray, filepath: str, detected: newdetect.SpotIntensities) -> None:
+    """Store PNG cutouts of the spots in a training_results dir next to the image file.
+
+    Parameters:
+        image: The sample image as a BGR numpy array.
+        filepath: Path of the sample image file.
+        detected: The spots found by newdetect in the image.
+
+    """
+    dirname, filename = os.path.split(filepath)
+    cutout_dir = os.path.join(dirname, "training_results")
+    makedirs(cutout_dir, exist_ok=True)
+    basename = "{0}_{1}".format(os.path.splitext(filename)[0].upper(), int(time()))
+    newdetect.writeCirclesToFiles(image, detected.masks, os.path.join(cutout_dir, basename))
+
+
+def predict_sample(resultdir: str, imagename: str, spots: List[int], results: Optional[Results] = None,
+                   image: Optional[np.ndarray] = None,
+                   mask_cache: Optional[newdetect.MaskCache] = None,
+                   roi: Optional[newdetect.FrameRoi] = None) -> Results:
+    """Predict the values of spots in a sample image.
+
+    Parameters:
+        resultdir: Directory holding the sample image.
+        imagename: File name of the sample image.
+        spots: The spot numbers to predict.
+        results: Results to fill in. New default results are made if None.
+        image: The sample image if already in memory. Read from file if None.
+        mask_cache: Circle masks shared between the images of one sample.
+        roi: The part of the camera frame the image covers. None if the
+            image is the whole frame.
+    Returns:
+        The results with the predicted spots filled in.
+
+    """
+    filepath = os.path.join(resultdir, imagename)
+    if image is None:
+        image = cv2.imread(filepath)
+        if image is None:
+            raise IOError("Could not read sample image {0}".format(filepath))
 
-
-def predict_sample(resultdir: str, imagename: str, spots: List[int], results: Optional[Results] = None) -> Results:
     # Post process the images for use by the prediction algorithm
     print("Pre-process image")
-    cut(os.path.join(resultdir, imagename))
-
-    # find images
-    path = os.path.join(resultdir, "training_results")
-    files = os.listdir(path)
-    suffix = 'csv'
-    files = [filename for filename in files if filename.endswith(suffix)]
+    with tracing.span("cut"):
+        intensities = cut(image, filepath, mask_cache, roi).intensities
 
     # make predictions
-    predictor = Predictor()
+    with tracing.span("predictor_init"):
+        predictor = Predictor()
 
     if results is None:
         results = create_default_results()
 
-    csv_path = os.path.join(path, files[0])
-    intensities = []
-    with open(csv_path, 'r') as infile:
-        lines = infile.readlines()
-    for line in lines:
-        name, intensitystr = line.strip().split(',')
-        intensities.append(float(intensitystr))
-
     error = None
     for spot in spots:
         try:
@@ -72,7 +130,8 @@ def predict_sample(resultdir: str, imagename: str, spots: List[int], results: Op
             else:
                 print(color)
                 print('Predicting spot {0}, {1}'.format(str(spot), color))
-                prediction = predictor.predict(intensity, color)
+                with tracing.span("predict"):
+                    prediction = predictor.predict(intensity, color)
 
             print("Prediction: {0}".format(prediction))
             results[realname] = prediction
@@ -8,14 +8,92 @@ import analyseconfig
 import numpy as np
 import pickle
 import os
+from time import time
 #from tflite_runtime.interpreter import Interpreter
 import polynomial
+import compactmodel
+
+class ModelRegistry:
+    """Registry keeping the prediction models loaded.
+
+    The model used for an ion is chosen by the <ION>_MODEL environment
+    variable, e.g. NITRATE_MODEL=3 uses models/nitrate/nitrate-3.p.
+    If the model has been exported with compactmodel, the .npz file next to
+    the pickle is used instead, as long as it was exported from the pickle as
+    it is now. Otherwise a warning is printed and the pickle is used.
+    A model is only read from disk again if the environment variable or the
+    modification time of one of the model files has changed since it was
+    loaded.
+
+    Example:
+        $ registry.load()
+
+        $ model = registry.get('nitrate')
+    """
+
+    ions = ('nitrate', 'phosphate')
+
+    def __init__(self):
+        '''Class init function. No models are loaded until asked for.'''
+        # ion: (pickle path, modification times of pickle and .npz, model)
+        self.loaded = {}
+
+    def model_path(self, ion):
+        '''Get the path of the pickled model file currently configured for an ion.'''
+        return os.path.join(analyseconfig.app_dir, 'models', ion,
+                            "%s-%s.p" % (ion, os.environ[ion.upper() + "_MODEL"]))
+
+    def get(self, ion):
+        '''Get the model for an ion, loading it if it is new or changed.
+
+        args:
+            ion(string): What ion to get the model for (nitrate, phosphate)
+
+        returns:
+            The model object.
+        '''
+        path = self.model_path(ion)
+        compact = compactmodel.compact_path(path)
+        mtimes = tuple(os.stat(p).st_mtime if os.path.isfile(p) else None for p in (path, compact))
+        cached = self.loaded.get(ion)
+        if cached is not None and cached[0] == path and cached[1] == mtimes:
+            return cached[2]
+        use_compact = False
+        if mtimes[1] is not None:
+            # Without the pickle there is nothing the compact file can be older than
+            use_compact = mtimes[0] is None or compactmodel.is_current(compact, path)
+            if not use_compact:
+                print("Warning: %s is not exported from the current %s, using the pickle. "
+                      "Run compactmodel.py on it again." % (compact, path))
+        if use_compact:
+            print("Loading %s model %s" % (ion, compact))
+            model = compactmodel.load(compact)
+        else:
+            print("Loading %s model %s" % (ion, path))
+            with open(path, "rb") as f:
+                model = pickle.load(f)
+        self.loaded[ion] = (path, mtimes, model)
+        return model
+
+    def load(self):
+        '''Make sure the models of all ions are loaded and up to date.
+
+        returns:
+            Dict with the model of each ion.
+        '''
+        return {ion: self.get(ion) for ion in self.ions}
+
+
+registry = ModelRegistry()
+"""The registry shared by the whole process."""
+
 
 class Predictor:
     """Predictor class.
 
-    This class loads the train model, and is meant to provide an easy way to
-    use the make predictions.
+    This class gets the trained models from the shared registry, and is meant
+    to provide an easy way to use the make predictions. Creating it is cheap
+    once the registry has loaded the models.
 
     Example:
         $ predictor = Predictor()
@@ -23,26 +101,17 @@ class Predictor:
         $ result = predictor(sample_data,color)
     """
 
-    def __init__(self):
+    def __init__(self, models=None):
         '''Class init function.
 
-        Loads a classifier for yellow,pink and blue color detection.
-        Defines a three neural networks (yellow,pink,blue), and loads the trained wheights.
+        args:
+            models(ModelRegistry): Registry to get the models from. The shared
+                registry if None.
         '''
 
-        self.models = {'nitrate': None,
-                       'phosphate': None}
-
-        nitrate_model_path = os.path.join(analyseconfig.app_dir, 'models/nitrate')
-        phosphate_model_path = os.path.join(analyseconfig.app_dir, 'models/phosphate')
-
-        nitrate_model_path = os.path.join(nitrate_model_path, "nitrate-%s.p" % os.environ["NITRATE_MODEL"])
-        model = pickle.load(open(nitrate_model_path, "rb"))
-        self.models['nitrate'] = model
-
-        phosphate_model_path = os.path.join(phosphate_model_path, "phosphate-%s.p" % os.environ["PHOSPHATE_MODEL"])
-        model = pickle.load(open(phosphate_model_path, "rb"))
-        self.models['phosphate'] = model
+        if models is None:
+            models = registry
+        self.models = models.load()
 
     def predict(self, intensity, ion):
         '''Predict is the main use of the Predictor class.
@@ -64,3 +133,62 @@ class Predictor:
         output = model.predict(np.array(intensity).reshape(-1, 1))[0]
 
         return output
+
+    def predict_many(self, intensities, ion):
+        '''Predict many samples of one ion with a single model call.
+
+        args:
+            intensities(np.array): The intensities of the samples. Flattened if
+                not one dimensional.
+            ion(string): What ion to analyse  (nitrate, phosphate)
+
+        returns:
+            output(np.array): Predicted values, one per sample.
+        '''
+
+        model = self.models[ion]
+
+        return model.predict(np.asarray(intensities, dtype=np.float64).reshape(-1, 1))
+
+    def predict_all(self, intensities):
+        '''Predict the samples of several ions, one model call per ion.
+
+        args:
+            intensities(dict): Ion name as key and the intensities as value.
+
+        returns:
+            output(dict): Ion name as key and the predicted values as value.
+        '''
+
+        return {ion: self.predict_many(values, ion) for ion, values in intensities.items()}
+
+
+def benchmark(count=100000):
+    '''Compare predicting one intensity at a time with predict_many.
+
+    Prints the throughput of both for every ion and checks they agree.
+
+    args:
+        count(int): Number of intensities to predict per ion.
+    '''
+    predictor = Predictor()
+    intensities = np.random.RandomState(0).uniform(50, 200, count)
+    for ion in ModelRegistry.ions:
+        start = time()
+        single = [predictor.predict(x, ion) for x in intensities]
+        single_time = time() - start
+        start = time()
+        many = predictor.predict_many(intensities, ion)
+        many_time = time() - start
+        print("%s: per call %.0f/s, batched %.0f/s, %.0fx faster, max difference %g" %
+              (ion, count / single_time, count / many_time, single_time / many_time,
+               np.max(np.abs(np.asarray(single) - many))))
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) in (2, 3) and sys.argv[1] == 'benchmark':
+        benchmark(*[int(a) for a in sys.argv[2:]])
+    else:
+        print("Usage: python3 predictor.py benchmark [count]")
+        sys.exit(1)
@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+"""Index of the stored results.
+
+The stored results are kept as one text file per analysis in the stored
+results dir. Parsing all of them for every listing gets slow when thousands
+have been stored, so the values of each file are also kept in an SQLite
+database, which is queried instead. The text files are still the primary
+copy, the index is brought up to date with them by sync, which reads the
+files added or changed since they were indexed.
+
+"""
+
+__copyright__ = "Copyright (C) 2020 Nordetect"
+
+import os
+import sys
+import sqlite3
+import threading
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+Values = Dict[str, Any]
+"""Values of a stored results file, as read by read_analysis in app."""
+
+results_suffix = ".results.txt"
+"""Ending of the stored results file names. The name before is the local id."""
+
+analytes = ['N1', 'N2', 'K', 'P']
+"""The analyte values stored in the results."""
+
+_schema = """
+CREATE TABLE IF NOT EXISTS results (
+    local_id TEXT PRIMARY KEY,
+    timestamp INTEGER NOT NULL,
+    account_id TEXT NOT NULL,
+    account_name TEXT NOT NULL,
+    barcode TEXT NOT NULL,
+    sample_id TEXT NOT NULL,
+    data_id TEXT NOT NULL,
+    uploaded INTEGER NOT NULL,
+    N1 REAL, N2 REAL, K REAL, P REAL,
+    mtime REAL
+);
+CREATE INDEX IF NOT EXISTS results_account_timestamp ON results (account_id, timestamp);
+CREATE INDEX IF NOT EXISTS results_uploaded ON results (uploaded);
+CREATE TABLE IF NOT EXISTS state (version INTEGER NOT NULL);
+INSERT INTO state SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM state);
+CREATE TABLE IF NOT EXISTS pending (account_id TEXT PRIMARY KEY, count INTEGER NOT NULL);
+DROP TRIGGER IF EXISTS pending_insert;
+CREATE TRIGGER pending_insert AFTER INSERT ON results WHEN NEW.uploaded = 0
+BEGIN
+    -- An upsert, as the OR REPLACE of the INSERT into results also applies
+    -- here and would replace an existing count with a new row
+    INSERT INTO pending (account_id, count) VALUES (NEW.account_id, 1)
+        ON CONFLICT (account_id) DO UPDATE SET count = count + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS pending_delete AFTER DELETE ON results WHEN OLD.uploaded = 0
+BEGIN
+    UPDATE pending SET count = count - 1 WHERE account_id = OLD.account_id;
+END;
+"""
+
+_count_pending = """
+DELETE FROM pending;
+INSERT INTO pending (account_id, count) SELECT account_id, COUNT(*) FROM results WHERE uploaded = 0 GROUP BY account_id;
+"""
+
+_bump_version = "UPDATE state SET version = version + 1"
+
+_insert = ("INSERT OR REPLACE INTO results (local_id, timestamp, account_id, account_name, barcode, sample_id,"
+           " data_id, uploaded, N1, N2, K, P, mtime) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
+
+
+def _row(local_id: str, values: Values, mtime: Optional[float]) -> tuple:
+    """Get the row to insert for one stored results file."""
+    return (local_id, int(local_id), str(values["account_id"]), values["account_name"], values["barcode"],
+            values["sample_id"], values["data_id"], values["uploaded"] == 'True',
+            *(values[analyte] for analyte in analytes), mtime)
+
+
+class ResultsIndex:
+
+    """SQLite index of the stored results files.
+
+    A single connection is shared by all threads of the app, serialized by a
+    lock. The database is in WAL mode, so a crash never leaves it half
+    written.
+
+    The number of results not uploaded is kept for each account by triggers
+    on the results table, so it changes in the same transaction as the
+    results.
+
+    """
+
+    def __init__(self, filename: str) -> None:
+        """Constructor. Opens the database, making it if needed.
+
+        Parameters:
+            filename: The SQLite database file.
+
+        """
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # Makes the rows deleted by INSERT OR REPLACE fire the delete trigger
+        self.db.execute("PRAGMA recursive_triggers=ON")
+        self.db.executescript(_schema)
+        columns = [column[1] for column in self.db.execute("PRAGMA table_info(results)")]
+        if "mtime" not in columns:
+            # Index made before the modification times were kept, the files
+            # are all read again by the next sync
+            self.db.execute("ALTER TABLE results ADD COLUMN mtime REAL")
+        # Count again at every start, as the counts may be from an older index
+        # or made by an older trigger
+        self.db.executescript("BEGIN;" + _count_pending + "COMMIT;")
+
+    @staticmethod
+    def local_id(filename: str) -> str:
+        """Get the local id of a stored results file.
+
+        Parameters:
+            filename: Path of the stored results file.
+        Returns:
+            The local id, which is the time of the analysis in seconds.
+
+        """
+        return os.path.basename(filename)[:-len(results_suffix)]
+
+    def put(self, local_id: str, values: Values, mtime: Optional[float] = None) -> None:
+        """Add or update the results of one stored results file.
+
+        Parameters:
+            local_id: The local id of the file.
+            values: The values in the file.
+            mtime: The modification time of the file, taken before reading
+                it. None makes the next sync read the file again.
+
+        """
+        row = _row(local_id, values, mtime)
+        with self.lock, self.db:
+            self.db.execute(_insert, row)
+            self.db.execute(_bump_version)
+
+    def sync(self, directory: str, read: Callable[[str], Values]) -> int:
+        """Bring the index up to date with the stored results files.
+
+        Only the files not indexed yet, or changed since they were indexed,
+        are read. On the first start this fills the index from all the files
+        stored. Files that cannot be read are left out, as they always were
+        from the stored results.
+
+        Parameters:
+            directory: The stored results dir.
+            read: Function reading the values of a stored results file.
+        Returns:
+            The number of files added to or updated in the index.
+
+        """
+        mtimes = {ResultsIndex.local_id(entry.name): entry.stat().st_mtime
+                  for entry in os.scandir(directory) if entry.name.endswith(results_suffix)}
+        with self.lock:
+            indexed = {row[0]: row[1] for row in self.db.execute("SELECT local_id, mtime FROM results")}
+        rows = []
+        removed = set(indexed) - set(mtimes)
+        for local_id in sorted(mtimes):
+            if local_id in indexed and indexed[local_id] is not None and indexed[local_id] >= mtimes[local_id]:
+                continue
+            try:
+                values = read(os.path.join(directory, local_id + results_suffix))
+                rows.append(_row(local_id, values, mtimes[local_id]))
+            except Exception:
+                if local_id in indexed:
+                    removed.add(local_id)
+        # One transaction, as a commit per file makes the first start slow
+        if rows or removed:
+            with self.lock, self.db:
+                self.db.executemany(_insert, rows)
+                self.db.executemany("DELETE FROM results WHERE local_id = ?", [(i,) for i in removed])
+                self.db.execute(_bump_version)
+        return len(rows)
+
+    def version(self) -> int:
+        """Get the version of the index, which changes on every change of it.
+
+        Returns:
+            The version number.
+
+        """
+        with self.lock:
+            return self.db.execute("SELECT version FROM state").fetchone()[0]
+
+    def pending_count(self, account_id: Optional[str] = None) -> int:
+        """Get the number of results not uploaded yet, without looking at them.
+
+        Parameters:
+            account_id: Only count the results of this account if given.
+        Returns:
+            The number of results that need uploading.
+
+        """
+        query = "SELECT TOTAL(count) FROM pending"
+        params: tuple = ()
+        if account_id is not None:
+            query += " WHERE account_id = ?"
+            params = (str(account_id),)
+        with self.lock:
+            return int(self.db.execute(query, params).fetchone()[0])
+
+    def get(self, local_id: str) -> Optional[sqlite3.Row]:
+        """Get the stored result with a local id.
+
+        Parameters:
+            local_id: The local id of the stored result.
+        Returns:
+            The row of the result, or None if not stored.
+
+        """
+        with self.lock:
+            return self.db.execute("SELECT * FROM results WHERE local_id = ?", (local_id,)).fetchone()
+
+    def has_pending(self, account_id: Optional[str] = None) -> bool:
+        """Check if any results are not uploaded yet.
+
+        Parameters:
+            account_id: Only check the results of this account if given.
+        Returns:
+            True if there are results that need uploading.
+
+        """
+        return self.pending_count(account_id) > 0
+
+    def results(self, account_id: Optional[str] = None) -> Iterator[sqlite3.Row]:
+        """Get the stored results, oldest first.
+
+        Parameters:
+            account_id: Only get the results of this account if given.
+        Returns:
+            The rows of the results, with the columns as keys.
+
+        """
+        query = "SELECT * FROM results"
+        params: tuple = ()
+        if account_id is not None:
+            query += " WHERE account_id = ?"
+            params = (str(account_id),)
+        with self.lock:
+            rows = self.db.execute(query + " ORDER BY timestamp", params).fetchall()
+        return iter(rows)
+
+    def query(self, account_id: Optional[str] = None, before: Optional[int] = None, after: Optional[int] = None,
+              barcode: Optional[str] = None, limit: Optional[int] = None,
+              page_size: int = 100) -> Iterator[sqlite3.Row]:
+        """Get stored results, newest first.
+
+        The rows are fetched page_size at a time, each page by a query
+        continuing after the last row of the previous page. The lock is only
+        held while fetching a page, so other threads are not blocked while
+        the rows are used.
+
+        Parameters:
+            account_id: Only get the results of this account if given.
+            before: Only get the results older than this time in seconds.
+                The local id of the last result of a page is the time to get
+                the next page.
+            after: Only get the results newer than this time in seconds.
+            barcode: Only get the results with this barcode if given.
+            limit: The most results to get, None for all.
+            page_size: Number of rows fetched by each query.
+        Returns:
+            The rows of the results, with the columns as keys.
+
+        """
+        conditions: List[str] = []
+        params: List[Any] = []
+        if account_id is not None:
+            conditions.append("account_id = ?")
+            params.append(str(account_id))
+        if barcode is not None:
+            conditions.append("barcode = ?")
+            params.append(barcode)
+        if after is not None:
+            conditions.append("timestamp > ?")
+            params.append(after)
+        conditions.append("timestamp < ?")
+        query = "SELECT * FROM results WHERE {0} ORDER BY timestamp DESC LIMIT ?".format(" AND ".join(conditions))
+        # Larger than any timestamp in seconds, if no before is given
+        upper = before if before is not None else 1 << 62
+        left = limit
+        while left is None or left > 0:
+            size = page_size if left is None else min(page_size, left)
+            with self.lock:
+                rows = self.db.execute(query, params + [upper, size]).fetchall()
+            yield from rows
+            if len(rows) < size:
+                break
+            upper = rows[-1]["timestamp"]
+            if left is not None:
+                left -= len(rows)
+
+
+def check() -> None:
+    """Check the count of results not uploaded follows puts of one account.
+
+    Raises:
+        AssertionError: If a count is wrong.
+
+    """
+    index = ResultsIndex(":memory:")
+    values = {"account_id": "7", "account_name": "Farm", "barcode": "", "sample_id": "", "data_id": "",
+              "uploaded": "False", "N1": 1.0, "N2": 1.0, "K": 1.0, "P": 1.0}
+    expected = [("1600000000", "False", 1), ("1600000060", "False", 2), ("1600000000", "True", 1),
+                ("1600000000", "True", 1), ("1600000060", "False", 1), ("1600000060", "True", 0)]
+    for local_id, uploaded, count in expected:
+        index.put(local_id, dict(values, uploaded=uploaded))
+        actual = index.db.execute("SELECT COUNT(*) FROM results WHERE uploaded = 0").fetchone()[0]
+        assert index.pending_count("7") == actual == count, (local_id, uploaded, index.pending_count("7"), count)
+        assert index.has_pending("7") == (count > 0)
+    print("Pending count ok")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 2 and sys.argv[1] == "check":
+        check()
+    else:
+        print("Usage: {0} check".format(sys.argv[0]))
+        sys.exit(1)
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""Queue of stored results to upload to the console in the background.
+
+Each upload is a job with an id, kept in an SQLite database so the queue
+survives restarts. A worker thread uploads the jobs that are due. When an
+upload fails for a reason that may go away, like no network, the job is
+tried again later, waiting twice as long after each failed try.
+
+"""
+
+__copyright__ = "Copyright (C) 2020 Nordetect"
+
+import sqlite3
+import threading
+import uuid
+from time import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import config
+import utils
+
+Job = Dict[str, Any]
+"""A job as a dict of the columns of the jobs table."""
+
+QUEUED = "queued"
+"""Status of a job waiting to be uploaded, the first time or again."""
+UPLOADING = "uploading"
+"""Status of a job being uploaded."""
+DONE = "done"
+"""Status of a job uploaded."""
+NEEDS_USER = "needs_user"
+"""Status of a job the user must decide on, like a sample not found."""
+FAILED = "failed"
+"""Status of a job that could not be uploaded."""
+RETRY = "retry"
+"""Outcome of an upload that should be tried again later."""
+
+_schema = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    local_id TEXT NOT NULL,
+    new_sample INTEGER NOT NULL,
+    has_sample_id INTEGER NOT NULL,
+    sample_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    created REAL NOT NULL,
+    next_try REAL NOT NULL,
+    result TEXT NOT NULL,
+    sample TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status_next_try ON jobs (status, next_try);
+CREATE INDEX IF NOT EXISTS jobs_local_id ON jobs (local_id);
+"""
+
+
+class UploadQueue:
+
+    """Persistent queue of upload jobs.
+
+    The jobs are uploaded by run, which is meant to run in a thread of its
+    own, while the other methods are used from any thread.
+
+    """
+
+    def __init__(self, filename: str) -> None:
+        """Constructor. Opens the database, making it if needed.
+
+        Parameters:
+            filename: The SQLite database file.
+
+        """
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(_schema)
+        columns = [column[1] for column in self.db.execute("PRAGMA table_info(jobs)")]
+        if "sample" not in columns:
+            self.db.execute("ALTER TABLE jobs ADD COLUMN sample TEXT")
+        with self.db:
+            # Uploads stopped by a restart are tried again
+            self.db.execute("UPDATE jobs SET status = ? WHERE status = ?", (QUEUED, UPLOADING))
+            self.db.execute("DELETE FROM jobs WHERE status IN (?, ?, ?) AND created < ?",
+                            (DONE, NEEDS_USER, FAILED, time() - config.upload_job_keep_time))
+
+    def add(self, local_id: str, new_sample: bool, has_sample_id: bool, sample_id: str,
+            sample: Optional[str] = None) -> str:
+        """Queue the upload of a stored result.
+
+        If the result is already queued, that job is used with the new
+        arguments and tried right away.
+
+        Parameters:
+            local_id: The local id of the stored result.
+            new_sample: Make a new sample for the result, instead of finding one.
+            has_sample_id: The sample id was given by the user.
+            sample_id: The sample id given.
+            sample: The console sample the result is uploaded to, as JSON,
+                when an earlier try already made or found it. None to make
+                or find the sample.
+        Returns:
+            The job id.
+
+        """
+        now = time()
+        with self.wakeup, self.db:
+            row = self.db.execute("SELECT job_id FROM jobs WHERE local_id = ? AND status IN (?, ?)",
+                                  (local_id, QUEUED, UPLOADING)).fetchone()
+            if row is not None:
+                job_id = row["job_id"]
+                self.db.execute("UPDATE jobs SET new_sample = ?, has_sample_id = ?, sample_id = ?, sample = ?,"
+                                " next_try = ? WHERE job_id = ?",
+                                (new_sample, has_sample_id, sample_id, sample, now, job_id))
+            else:
+                job_id = uuid.uuid4().hex
+                self.db.execute("INSERT INTO jobs (job_id, local_id, new_sample, has_sample_id, sample_id, status,"
+                                " attempts, created, next_try, result, sample) VALUES (?, ?, ?, ?, ?, ?, 0, ?, ?, '', ?)",
+                                (job_id, local_id, new_sample, has_sample_id, sample_id, QUEUED, now, now, sample))
+            self.wakeup.notify()
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """Get a job.
+
+        Parameters:
+            job_id: The id of the job.
+        Returns:
+            The job, or None if there is no such job.
+
+        """
+        with self.lock:
+            row = self.db.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return None if row is None else dict(row)
+
+    def _due(self, now: float) -> List[Job]:
+        """Get the queued jobs to try now, oldest first. The lock must be held."""
+        rows = self.db.execute("SELECT * FROM jobs WHERE status = ? AND next_try <= ? ORDER BY created",
+                               (QUEUED, now)).fetchall()
+        return [dict(row) for row in rows]
+
+    def _wait_time(self, now: float) -> Optional[float]:
+        """Get the seconds until the next job is due, None if none queued. The lock must be held."""
+        row = self.db.execute("SELECT MIN(next_try) FROM jobs WHERE status = ?", (QUEUED,)).fetchone()
+        return None if row[0] is None else max(row[0] - now, 0)
+
+    @staticmethod
+    def _retry_time(tries: int) -> float:
+        """Get the seconds to wait before trying again after failed tries."""
+        return min(config.upload_retry_min_time * 2 ** (tries - 1), config.upload_retry_max_time)
+
+    def _postpone(self, jobs: List[Job], delay: float) -> None:
+        """Queue jobs again to be tried later, without counting it as a try."""
+        with self.lock, self.db:
+            self.db.executemany("UPDATE jobs SET status = ?, next_try = ? WHERE job_id = ?",
+                                [(QUEUED, time() + delay, job["job_id"]) for job in jobs])
+
+    def _finish(self, job: Job, status: str, result: str, sample: Optional[str] = None) -> None:
+        """Store the outcome of an upload of a job, and the console sample made or found by it, if any."""
+        attempts = job["attempts"] + 1
+        now = time()
+        if status == RETRY:
+            if attempts >= config.upload_max_attempts:
+                status = FAILED
+            else:
+                status = QUEUED
+        delay = UploadQueue._retry_time(attempts)
+        with self.lock, self.db:
+            self.db.execute("UPDATE jobs SET status = ?, attempts = ?, next_try = ?, result = ?,"
+                            " sample = COALESCE(?, sample) WHERE job_id = ?",
+                            (status, attempts, now + delay, result, sample, job["job_id"]))
+            if status == DONE:
+                # The console is reachable again, so do not wait to try the others
+                self.db.execute("UPDATE jobs SET next_try = ? WHERE status = ? AND next_try > ?",
+                                (now, QUEUED, now))
+
+    def run(self, upload: Callable[[Job], Tuple[str, str, Optional[str]]], connected: Callable[[], bool]) -> None:
+        """Upload the jobs when they are due, forever.
+
+        All jobs due are uploaded one after the other after checking the
+        console can be reached once.
+
+        Parameters:
+            upload: Function uploading the stored result of a job. Returns
+                the status of the job (DONE, NEEDS_USER, FAILED or RETRY), the
+                result to show for it and the console sample the next try
+                must upload to, as JSON, or None if no sample was made or
+                found.
+            connected: Function checking if the console can be reached.
+
+        """
+        # Checks in a row not reaching the console
+        offline = 0
+        while True:
+            with self.wakeup:
+                now = time()
+                jobs = self._due(now)
+                if not jobs:
+                    self.wakeup.wait(self._wait_time(now))
+                    continue
+                # Only take the jobs no other process has taken meanwhile
+                claimed = []
+                with self.db:
+                    for job in jobs:
+                        cursor = self.db.execute("UPDATE jobs SET status = ? WHERE job_id = ? AND status = ?",
+                                                 (UPLOADING, job["job_id"], QUEUED))
+                        if cursor.rowcount == 1:
+                            claimed.append(job)
+                jobs = claimed
+            if not jobs:
+                continue
+            if not connected():
+                # Not a try of the uploads, so they do not fail from being offline long
+                offline += 1
+                self._postpone(jobs, UploadQueue._retry_time(offline))
+                continue
+            offline = 0
+            for job in jobs:
+                try:
+                    status, result, sample = upload(job)
+                except Exception as e:
+                    utils.backend_logger(f'upload job {job["job_id"]} error: {repr(e)}')
+                    status, result, sample = RETRY, repr(e), None
+                self._finish(job, status, result, sample)
@@ -2,7 +2,9 @@
  */
 
 #include <stdint.h>
+#include <stdio.h>
 #include <stdlib.h>
+#include <string.h>
 #include <errno.h>
 
 #include "ws2811.h"
@@ -47,15 +49,15 @@ void set_color(ws2811_led_t color)
     }
 }
 
-int main(int argc, char *argv[])
+/* Parse a color given as hexadecimal RRGGBB.
+ * Returns 0 on success or the exit code for the error.
+ */
+int parse_color(const char *text, ws2811_led_t *color)
 {
     unsigned long arg;
-    ws2811_return_t ret;
-    
-    if (argc != 2) {
-        return 1;
-    }
-    arg = strtoul(argv[1], NULL, 16);
+
+    errno = 0;
+    arg = strtoul(text, NULL, 16);
     if (arg == 0) {
         // Maybe an error occured, check it
         if (errno == EINVAL) return 2;
@@ -64,11 +66,55 @@ int main(int argc, char *argv[])
     if (arg > 0xffffffff) {
         return 3;
     }
-    
+    *color = (ws2811_led_t)arg;
+    return 0;
+}
+
+/* Keep the LED strip initialized and set a color for every line read from
+ * stdin, answering each with the result code on a line of its own.
+ * Saves initializing the strip for every change of color.
+ */
+int serve(void)
+{
+    char line[64];
+    ws2811_led_t color;
+    int ret;
+
     if ((ret = ws2811_init(&ledstring)) != WS2811_SUCCESS) return ret;
-    set_color((ws2811_led_t)arg);
+    while (fgets(line, sizeof(line), stdin) != NULL) {
+        ret = parse_color(line, &color);
+        if (ret == 0) {
+            set_color(color);
+            ret = ws2811_render(&ledstring);
+        }
+        printf("%d\n", ret);
+        fflush(stdout);
+    }
+    ws2811_fini(&ledstring);
+
+    return 0;
+}
+
+int main(int argc, char *argv[])
+{
+    ws2811_led_t color;
+    ws2811_return_t ret;
+    int parse_ret;
+
+    if (argc != 2) {
+        return 1;
+    }
+    if (strcmp(argv[1], "-") == 0) {
+        return serve();
+    }
+    if ((parse_ret = parse_color(argv[1], &color)) != 0) {
+        return parse_ret;
+    }
+
+    if ((ret = ws2811_init(&ledstring)) != WS2811_SUCCESS) return ret;
+    set_color(color);
     ret = ws2811_render(&ledstring);
     ws2811_fini(&ledstring);
-    
+
     return ret;
 }
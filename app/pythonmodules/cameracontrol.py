@@ -9,13 +9,16 @@ See description in the test/simulate module.
 
 __copyright__ = "Copyright (C) 2020 Nordetect"
 
-from typing import Tuple, List, Optional
+from typing import Deque, Tuple, List, Optional
+from collections import deque
+import threading
 try:
     from simulate import fake_capture
 except ImportError:
     fake_capture = {}
 from time import sleep, time, clock_gettime, CLOCK_MONOTONIC
 import lightcontrol
+import tracing
 from lightcontrol import RGB
 import cv2
 import numpy as np
@@ -32,6 +35,172 @@ else:
             pass
 
 WINDOW = Tuple[int, int, int, int]
+ROI = Tuple[int, int, int, int]
+"""Region of interest in a frame as (x, y, width, height)."""
+
+
+StreamFrame = Tuple[float, float, np.ndarray]
+"""A streamed frame as (monotonic capture time, capture time stamp, image)."""
+
+
+class FrameStream:
+
+    """Frames captured continuously through the video port of the camera.
+
+    A background thread keeps the latest frames in a ring buffer together
+    with the time they were captured. This gives many more frames per second
+    than capturing through the still port, so an average can be taken over
+    all frames in a short window around a point in time.
+
+    """
+
+    fake_frame_rate = 10.0
+    """Frames per second made when simulating the camera."""
+
+    def __init__(self, camera: 'Camera', size: int) -> None:
+        """Constructor. The stream is not started until calling start.
+
+        Parameters:
+            camera: The Camera to capture from.
+            size: Number of the latest frames kept.
+
+        """
+        self.camera = camera
+        self.frames: Deque[StreamFrame] = deque(maxlen=size)
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """Start capturing frames in the background."""
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="FrameStream", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        """Stop capturing frames and wait for the capture thread to end."""
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def add(self, frame: np.ndarray) -> None:
+        """Add a frame just captured to the ring buffer."""
+        with self.condition:
+            self.frames.append((clock_gettime(CLOCK_MONOTONIC), time(), frame))
+            self.condition.notify_all()
+
+    def run(self) -> None:
+        """Capture frames until stopped. Run by the capture thread."""
+        if fake_capture:
+            while self.running:
+                self.add(self.camera.fake_frame())
+                sleep(1 / FrameStream.fake_frame_rate)
+        else:
+            buf = PiRGBArray(self.camera.cam)
+            for _ in self.camera.cam.capture_continuous(buf, 'bgr', use_video_port=True):
+                # A new array is made for every frame, so no need to copy it
+                self.add(buf.array)
+                buf.truncate(0)
+                if not self.running:
+                    break
+
+    def frames_between(self, start: float, end: float, timeout: float) -> List[StreamFrame]:
+        """Get the frames captured in a time window, waiting for the window to pass.
+
+        Parameters:
+            start: Monotonic time of the start of the window.
+            end: Monotonic time of the end of the window.
+            timeout: Seconds to wait at most.
+        Returns:
+            The frames in the window. If the frame rate is too low to get a
+            frame inside the window, the first frame after the start.
+            An empty list if no frame came before the timeout.
+
+        """
+        deadline = clock_gettime(CLOCK_MONOTONIC) + timeout
+        with self.condition:
+            while not self.frames or self.frames[-1][0] < end:
+                remaining = deadline - clock_gettime(CLOCK_MONOTONIC)
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            after_start = [f for f in self.frames if f[0] >= start]
+        frames = [f for f in after_start if f[0] <= end]
+        return frames if frames else after_start[:1]
+
+
+class FrameAccumulator:
+
+    """Running sum of frames for taking the average of many frames.
+
+    The sum buffers are allocated once and every frame is added in place, so
+    the number of frames averaged over does not change the memory used.
+
+    """
+
+    def __init__(self, shape: Tuple[int, ...], variance: bool = False) -> None:
+        """Constructor.
+
+        Parameters:
+            shape: Shape of the frames (height, width, colorvalues).
+            variance: Also sum the squares, to be able to get the variance.
+
+        """
+        # float32 holds the sum of uint8 frames exactly for far more frames
+        # than we will ever take, and is what cv2.accumulate adds fastest to.
+        self.sum = np.zeros(shape, np.float32)
+        self.squaresum: Optional[np.ndarray] = np.zeros(shape, np.float32) if variance else None
+        self.count = 0
+
+    def reset(self) -> None:
+        """Start a new sum, reusing the buffers."""
+        self.sum.fill(0)
+        if self.squaresum is not None:
+            self.squaresum.fill(0)
+        self.count = 0
+
+    def add(self, frame: np.ndarray) -> None:
+        """Add a frame to the sum.
+
+        Parameters:
+            frame: The uint8 frame with the shape given on construction.
+
+        """
+        cv2.accumulate(frame, self.sum)
+        if self.squaresum is not None:
+            cv2.accumulateSquare(frame, self.squaresum)
+        self.count += 1
+
+    def mean(self) -> np.ndarray:
+        """Get the average of the frames added.
+
+        Returns:
+            A new uint8 array with the average, rounded down.
+
+        """
+        average = np.empty(self.sum.shape, np.uint8)
+        np.divide(self.sum, self.count, out=average, casting='unsafe')
+        return average
+
+    def variance(self) -> np.ndarray:
+        """Get the variance of each pixel over the frames added.
+
+        This can be used as a noise map. Only available if constructed
+        with variance set.
+
+        Returns:
+            A new float32 array with the variance.
+
+        """
+        if self.squaresum is None:
+            raise ValueError("The accumulator was made without variance")
+        mean = np.divide(self.sum, self.count)
+        variance = np.divide(self.squaresum, self.count)
+        variance -= mean * mean
+        # Rounding errors can give slightly negative values
+        np.maximum(variance, 0, out=variance)
+        return variance
 
 
 class Camera:
@@ -57,10 +226,27 @@ class Camera:
     rgb_gains = (1.0, 1.0)
     """Gain settings used with RGB light."""
     light_settle_time = 0.5
-    """Time needed from setting the light until it is ready."""
+    """Time needed from setting the light until it is ready.
+    With detect_light_settle, this is the longest time waited."""
+    detect_light_settle = True
+    """Detect when the light has settled from small frames captured after a
+    light change, instead of always waiting light_settle_time."""
+    light_settle_min_time = 0.1
+    """Time to wait before looking at frames, so frames captured before the
+    light change has reached the camera are not used."""
+    light_settle_threshold = 0.5
+    """Largest change of the mean intensity between frames of settled light."""
+    light_settle_frames = 3
+    """Number of frames in a row within the threshold to call the light settled."""
+    light_settle_frame_size = (64, 48)
+    """Size of the frames used to detect the light has settled."""
     camera_warmup_time = 15
     """Time needed from initializing the camera until it is ready."""
     capture_resulution = (640, 480)
+    stream_frames = 90
+    """Number of frames kept by the video port stream."""
+    stream_startup_time = 1.0
+    """Time to start the video port stream before the frames are needed."""
 
     def __init__(self) -> None:
         """Constructor. The camera warmup time is counted from here.
@@ -86,6 +272,10 @@ class Camera:
         self.rgb = (-1, -1, -1)
         self.uv = -1
         self.timestamp = 0.0
+        self.accumulator: Optional[FrameAccumulator] = None
+        self.stream: Optional[FrameStream] = None
+        self.roi: Optional[ROI] = None
+        self.noise_map: Optional[np.ndarray] = None
 
     def setup_uv(self) -> None:
         """Change the camera to UV light mode."""
@@ -113,7 +303,8 @@ class Camera:
         changed = False
         if (rgb != self.rgb):
             self.rgb = rgb
-            lightcontrol.setcolor(rgb)
+            # The settle detection makes the fixed wait after the change needless
+            lightcontrol.setcolor(rgb, 0 if Camera.detect_light_settle else 10)
             changed = True
         if uv != self.uv:
             self.uv = uv
@@ -133,20 +324,71 @@ class Camera:
             How long it waited.
 
         """
+        start = clock_gettime(CLOCK_MONOTONIC)
         waittime = 0.0
-        now = 0.0
-        if wait_for_light and not self.light_settled:
-            now = clock_gettime(CLOCK_MONOTONIC)
-            waittime = Camera.light_settle_time - (now - self.light_change)
-            self.light_settled = True
+        wait_for_light = wait_for_light and not self.light_settled
+        # The video port is busy while streaming, so use the fixed time then
+        detect_light = wait_for_light and Camera.detect_light_settle and self.stream is None
+        if wait_for_light and not detect_light:
+            waittime = Camera.light_settle_time - (start - self.light_change)
         if not self.cam_ready:
-            if now == 0:
-                now = clock_gettime(CLOCK_MONOTONIC)
-            waittime = max(waittime, Camera.camera_warmup_time - (now - self.cam_inittime))
+            # Also needed before the frames used to detect the light settle
+            waittime = max(waittime, Camera.camera_warmup_time - (start - self.cam_inittime))
             self.cam_ready = True
-        if waittime > 0:
-            sleep(waittime)
-        return max(waittime, 0)
+        # Also timed when not waiting, so the percentiles count every call
+        with tracing.span("wait_for_ready"):
+            if waittime > 0:
+                sleep(waittime)
+        if detect_light:
+            self.wait_for_light()
+        if wait_for_light:
+            self.light_settled = True
+        return clock_gettime(CLOCK_MONOTONIC) - start
+
+    def settle_frame_mean(self) -> float:
+        """Capture a small frame and get its mean intensity."""
+        if fake_capture:
+            frame = cv2.resize(self.fake_frame(), Camera.light_settle_frame_size, interpolation=cv2.INTER_AREA)
+        else:
+            output = PiRGBArray(self.cam, size=Camera.light_settle_frame_size)
+            self.cam.capture(output, 'bgr', use_video_port=True, resize=Camera.light_settle_frame_size)
+            frame = output.array
+        return float(frame.mean())
+
+    def wait_for_light(self) -> float:
+        """Wait until the light has settled after the last light change.
+
+        Small frames are captured until the mean intensity has stayed within
+        light_settle_threshold for light_settle_frames frames, or until
+        light_settle_time has passed since the change.
+
+        Returns:
+            Seconds from the light change until it was settled.
+
+        """
+        deadline = self.light_change + Camera.light_settle_time
+        color = "{0:02x}{1:02x}{2:02x}".format(*self.rgb) if min(self.rgb) >= 0 else "none"
+        if self.uv > 0:
+            color += "_uv"
+        with tracing.span("light_settle_" + color):
+            sleep_time = self.light_change + Camera.light_settle_min_time - clock_gettime(CLOCK_MONOTONIC)
+            if sleep_time > 0:
+                sleep(sleep_time)
+            last_mean = None
+            stable_frames = 0
+            while clock_gettime(CLOCK_MONOTONIC) < deadline and stable_frames < Camera.light_settle_frames:
+                mean = self.settle_frame_mean()
+                if last_mean is not None and abs(mean - last_mean) <= Camera.light_settle_threshold:
+                    stable_frames += 1
+                else:
+                    stable_frames = 0
+                last_mean = mean
+            settle_time = clock_gettime(CLOCK_MONOTONIC) - self.light_change
+        if stable_frames < Camera.light_settle_frames:
+            print("Light {0} not detected settled within {1:.3f} s".format(color, settle_time))
+        else:
+            print("Light {0} settled after {1:.3f} s".format(color, settle_time))
+        return settle_time
 
     def capture_image(self) -> None:
         """Capture a single image. Set a time stamp on it after capture."""
@@ -156,16 +398,51 @@ class Camera:
         self.wait_for_ready()
         # Take the picture
         if fake_capture:
-            (r, b, g) = self.rgb
-            color = (r, b, g, self.uv)
-            if color not in fake_capture:
-                color = (-1, -1, -1, -1)
-            infilename = fake_capture[color]
-            self.buf.array = cv2.imread(infilename)
+            self.buf.array = self.fake_frame()
         else:
             self.cam.capture(self.buf, 'bgr')
         self.timestamp = time()
 
+    def fake_frame(self) -> np.ndarray:
+        """Get the image given by the simulation for the current light."""
+        (r, b, g) = self.rgb
+        color = (r, b, g, self.uv)
+        if color not in fake_capture:
+            color = (-1, -1, -1, -1)
+        return cv2.imread(fake_capture[color])
+
+    def crop(self, frame: np.ndarray) -> np.ndarray:
+        """Get the region of interest of a frame.
+
+        Parameters:
+            frame: A full frame from the camera.
+        Returns:
+            A view of the region of interest of the frame without copying it,
+            or the frame itself if no region of interest is set.
+
+        """
+        if self.roi is None:
+            return frame
+        x, y, width, height = self.roi
+        return frame[y:y + height, x:x + width]
+
+    def start_stream(self) -> None:
+        """Start capturing continuously through the video port.
+
+        While the stream runs, capture_average with a window takes its
+        frames from the stream.
+
+        """
+        if self.stream is None:
+            self.stream = FrameStream(self, Camera.stream_frames)
+            self.stream.start()
+
+    def stop_stream(self) -> None:
+        """Stop capturing continuously."""
+        if self.stream is not None:
+            self.stream.stop()
+            self.stream = None
+
     def capture_bayer_image(self, basename) -> None:
         """Capture a single image with appended bayer data. Set a time stamp on it after capture."""
 
@@ -183,14 +460,18 @@ class Camera:
         filename = "{0}_{1:.2f}.jpg".format(basename, self.timestamp)
         self.cam.capture(f"{filename}", 'jpeg', bayer=True)
 
-    def save_image(self, filename: str) -> None:
+    def save_image(self, filename: str, image: Optional[np.ndarray] = None) -> None:
         """Save the image to a file (in png format).
 
         Parameters:
             filename: The full path of where to store the image.
+            image: Image to save, e.g. one captured earlier. The image in the
+                buffer if None.
 
         """
-        cv2.imwrite(filename, self.buf.array)
+        if image is None:
+            image = self.buf.array
+        cv2.imwrite(filename, image)
 
     def save_stamped_image(self, basename: str) -> None:
         """Save the image with the stamp as part of the name.
@@ -206,7 +487,8 @@ class Camera:
         filename = "{0}_{1:.2f}.png".format(basename, self.timestamp)
         self.save_image(filename)
 
-    def capture_average(self, timelist: Optional[List[float]] = None, starttime: Optional[float] = None) -> None:
+    def capture_average(self, timelist: Optional[List[float]] = None, starttime: Optional[float] = None,
+                        noise_map: bool = False, window: Optional[float] = None) -> None:
         """capture images and save an average over them.
 
         It will count the timing from right after entering this function
@@ -214,9 +496,19 @@ class Camera:
         If the capture can not keep up with the times given, it will just
         capture as fast as possible.
 
+        If a region of interest is set, only that part of the frames is
+        averaged and the average is of the size of the region.
+
+        With a window, the average is taken over all frames captured through
+        the video port within the window around each of the times. The
+        stream is started for the capture if it is not already running.
+
         Parameters:
             timelist: A list of times counted as seconds since calling this.
             starttime: Time to count from. If None, count from calling this.
+            noise_map: Also store the variance of each pixel in noise_map.
+            window: Seconds around each time to take stream frames from.
+                If None, a single still image is captured at each time.
 
         """
         if starttime is None:
@@ -226,26 +518,89 @@ class Camera:
         if timelist is None:
             # Just used three images captured as fast as possible
             timelist = [0, 0, 0]
-        imagecount = len(timelist)
-        # We need to cast from uint8 to something where we will not get
-        # overruns.
-        # Using np.float32 as that seems to be the fastest.
+        # The accumulator is kept between calls, so its buffers are reused.
         # Image array dimensions is height, width, colorvalues.
-        array_dimensions = (self.capture_resulution[1], self.capture_resulution[0], 3)
-        imagesum = np.zeros(array_dimensions, np.float32)
+        if self.roi is None:
+            array_dimensions = (self.capture_resulution[1], self.capture_resulution[0], 3)
+        else:
+            array_dimensions = (self.roi[3], self.roi[2], 3)
+        accumulator = self.accumulator
+        if accumulator is None or accumulator.sum.shape != array_dimensions or \
+                (noise_map and accumulator.squaresum is None):
+            accumulator = FrameAccumulator(array_dimensions, noise_map)
+            self.accumulator = accumulator
+        accumulator.reset()
+        if window:
+            timestamp = self.average_stream(timelist, start_run_time, window, accumulator)
+        else:
+            timestamp = self.average_stills(timelist, start_run_time, accumulator)
+        # mean gives a new array, so references to earlier averages stay valid
+        self.buf.array = accumulator.mean()
+        self.noise_map = accumulator.variance() if noise_map else None
+        self.timestamp = timestamp
+
+    def average_stills(self, timelist: List[float], start_run_time: float, accumulator: FrameAccumulator) -> float:
+        """Add a still image captured at each time to an accumulator.
+
+        Returns:
+            The time stamp of the middle image.
+
+        """
+        imagecount = len(timelist)
         self.wait_for_ready()
         for index, delta_time in enumerate(timelist):
             run_time = clock_gettime(CLOCK_MONOTONIC) - start_run_time
             sleep_time = delta_time - run_time
-            if sleep_time > 0:
-                sleep(sleep_time)
-            self.capture_image()
-            imagesum += self.buf.array.astype(np.float32)
+            # Waiting for the chemistry, so kept apart from the capture time
+            with tracing.span("capture_schedule_wait"):
+                if sleep_time > 0:
+                    sleep(sleep_time)
+            with tracing.span("capture_image"):
+                self.capture_image()
+            accumulator.add(self.crop(self.buf.array))
             if index == imagecount // 2:
                 timestamp = self.timestamp
-        imagesum /= imagecount
-        self.buf.array = imagesum.astype(np.uint8)
-        self.timestamp = timestamp
+        return timestamp
+
+    def average_stream(self, timelist: List[float], start_run_time: float, window: float,
+                       accumulator: FrameAccumulator) -> float:
+        """Add the stream frames in a window around each time to an accumulator.
+
+        Returns:
+            The time stamp of the middle frame around the middle time.
+
+        """
+        imagecount = len(timelist)
+        started_stream = self.stream is None
+        if started_stream:
+            # Only stream around the captures, not during the long waits
+            sleep_time = start_run_time + min(timelist) - window / 2 - Camera.stream_startup_time \
+                - clock_gettime(CLOCK_MONOTONIC)
+            with tracing.span("capture_schedule_wait"):
+                if sleep_time > 0:
+                    sleep(sleep_time)
+            self.start_stream()
+        try:
+            self.wait_for_ready()
+            # Frames from before the light settled are not used
+            ready_time = clock_gettime(CLOCK_MONOTONIC)
+            for index, delta_time in enumerate(timelist):
+                center = start_run_time + delta_time
+                start = max(center - window / 2, ready_time)
+                end = max(center + window / 2, start)
+                timeout = end - clock_gettime(CLOCK_MONOTONIC) + Camera.stream_startup_time + 1
+                with tracing.span("capture_stream_wait"):
+                    frames = self.stream.frames_between(start, end, timeout)
+                if not frames:
+                    raise RuntimeError("No frames from the camera stream")
+                for _, _, frame in frames:
+                    accumulator.add(self.crop(frame))
+                if index == imagecount // 2:
+                    timestamp = frames[len(frames) // 2][1]
+        finally:
+            if started_stream:
+                self.stop_stream()
+        return timestamp
 
     def capture(self, basename: str, timelist: Optional[List[float]] = None, wait_first: bool = False, bayer=False) -> None:
         """Capture a series of images on specific times.
@@ -1,10 +1,19 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-"""Control of light."""
+"""Control of light.
+
+The LED strip is driven by a long lived driver, so changing the color only
+costs writing the new color. The driver is chosen when first used:
+The neopixel python bindings in this process if they are installed,
+otherwise a setlight program kept running in server mode. When simulating
+the light, a fake driver just remembers the colors set.
+
+"""
 
 __copyright__ = "Copyright (C) 2020 Nordetect"
 
 import sys
+import select
 try:
     from simulate import fake_light
 except ImportError:
@@ -13,10 +22,14 @@ from os.path import basename
 from time import sleep
 from sys import argv
 import subprocess
-from typing import Tuple
+from typing import List, Optional, Tuple
 from colortable import colortable
 if not fake_light:
     import RPi.GPIO as GPIO
+    try:
+        import neopixel
+    except ImportError:
+        neopixel = None
 
 
 RGB = Tuple[int,  int,  int]
@@ -26,6 +39,173 @@ WRONG_ARGUMENT = 1
 UNKNOWN_ERROR = 2
 
 
+class SetlightDriver:
+
+    """LED driver using the setlight program in server mode.
+
+    The program initializes the LED strip once and then sets a color for
+    every line written to it. If it does not answer in time, it is killed
+    and the color is set by running setlight for that color alone, as
+    before the server mode. The next color starts a new program.
+
+    """
+
+    answer_timeout = 2.0
+    """Seconds to wait for the answer of the program."""
+
+    def __init__(self) -> None:
+        """Constructor. The program is started on the first color set."""
+        self.process: Optional[subprocess.Popen] = None
+
+    def start(self) -> subprocess.Popen:
+        """Start the setlight program if it is not running.
+
+        Returns:
+            The running program.
+
+        """
+        if self.process is None or self.process.poll() is not None:
+            self.process = subprocess.Popen(['setlight', '-'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                            universal_newlines=True, bufsize=1)
+        return self.process
+
+    def send(self, colorvalue: str) -> bool:
+        """Send a color to the program and wait for its answer.
+
+        Parameters:
+            colorvalue: The color as made by colorstring.
+        Returns:
+            True if the color was set. False if the program failed, did not
+            answer in time or died, and then it is killed.
+
+        """
+        process = self.start()
+        try:
+            process.stdin.write(colorvalue + '\n')
+            process.stdin.flush()
+            ready, _, _ = select.select([process.stdout], [], [], SetlightDriver.answer_timeout)
+            answer = process.stdout.readline() if ready else ''
+        except BrokenPipeError:
+            answer = ''
+        if answer.strip() == '0':
+            return True
+        # Do not reuse a program in an unknown state
+        self.kill()
+        return False
+
+    def set(self, colorvalue: str) -> None:
+        """Set the color of the LED's.
+
+        Parameters:
+            colorvalue: The color as made by colorstring.
+
+        """
+        if self.send(colorvalue):
+            return
+        res = subprocess.run(['setlight', colorvalue], timeout=SetlightDriver.answer_timeout)
+        if res.returncode != 0:
+            raise Exception("Could not change the LED color")
+
+    def kill(self) -> None:
+        """Kill the setlight program."""
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+
+    def close(self) -> None:
+        """Stop the setlight program. The LED's keep their color."""
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+            try:
+                self.process.wait(SetlightDriver.answer_timeout)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+            self.process = None
+
+
+class NeoPixelDriver:
+
+    """LED driver using the neopixel python bindings of rpi_ws281x in process.
+
+    The settings must match the ones in lightcontrol/setlight.c.
+
+    """
+
+    led_count = 12
+    gpio_pin = 12
+    dma = 10
+
+    def __init__(self) -> None:
+        """Constructor. Initializes the LED strip."""
+        self.strip = neopixel.Adafruit_NeoPixel(NeoPixelDriver.led_count, NeoPixelDriver.gpio_pin, 800000,
+                                                NeoPixelDriver.dma, False, 255, 0, neopixel.ws.WS2811_STRIP_GRB)
+        self.strip.begin()
+
+    def set(self, colorvalue: str) -> None:
+        """Set the color of the LED's.
+
+        Parameters:
+            colorvalue: The color as made by colorstring.
+
+        """
+        color = int(colorvalue, 16)
+        for i in range(NeoPixelDriver.led_count):
+            self.strip.setPixelColor(i, color)
+        self.strip.show()
+
+    def close(self) -> None:
+        """Nothing to do, the LED's keep their color."""
+        pass
+
+
+class FakeDriver:
+
+    """LED driver for simulation, remembering the colors set."""
+
+    def __init__(self) -> None:
+        """Constructor."""
+        self.colors: List[str] = []
+
+    def set(self, colorvalue: str) -> None:
+        """Remember the color set.
+
+        Parameters:
+            colorvalue: The color as made by colorstring.
+
+        """
+        self.colors.append(colorvalue)
+
+    def close(self) -> None:
+        """Nothing to do."""
+        pass
+
+
+_driver = None
+
+
+def driver():
+    """Get the LED driver, making it when first used.
+
+    Returns:
+        The LED driver used by this process.
+
+    """
+    global _driver
+    if _driver is None:
+        if fake_light:
+            _driver = FakeDriver()
+        elif neopixel is not None:
+            _driver = NeoPixelDriver()
+        else:
+            _driver = SetlightDriver()
+    return _driver
+
+
 def uv_on() -> None:
     """Turn on the UV light."""
     if not fake_light:
@@ -64,7 +244,7 @@ def colorstring(rgb: RGB) -> str:
 
 
 def setcolorvalue(colorvalue: str, wait_ms: int = 10) -> None:
-    """Set the color of the LED's using the external setlight program.
+    """Set the color of the LED's using the LED driver.
 
     Parameters:
         colorvalue: The color string representing the color we want.
@@ -72,15 +252,13 @@ def setcolorvalue(colorvalue: str, wait_ms: int = 10) -> None:
         wait_ms: Wait many milliseconds after setting the color.
 
     """
-    if not fake_light:
-        res = subprocess.run(['setlight', '{0}'.format(colorvalue)])
-        if res.returncode != 0:
-            raise Exception("Could not change the LED color")
-    sleep(wait_ms/1000.0)
+    driver().set(colorvalue)
+    if wait_ms > 0:
+        sleep(wait_ms/1000.0)
 
 
 def setcolor(rgb: RGB, wait_ms: int = 10) -> None:
-    """Set the color of the LED's using the exteranl setlight program.
+    """Set the color of the LED's using the LED driver.
 
     Parameters:
         rgb: An RGB tuple representing the coler to set.
@@ -171,5 +349,6 @@ if __name__ == '__main__':
             usage(callname)
             sys.exit(WRONG_ARGUMENT)
         setcolor(color)
+        driver().close()
     except Exception:
         sys.exit(UNKNOWN_ERROR)
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""Lightweight timing of the stages of a sample check.
+
+A run is started with start_run(). While it is active, code anywhere in the
+process can time a stage with:
+
+    with tracing.span("capture_average"):
+        ...
+
+or add a time measured elsewhere with add_span(). Without an active run the
+spans cost next to nothing and are not recorded. finish_run() appends the
+run as one JSON line to a rolling file keeping the last runs only, which
+read_runs() and stage_percentiles() use to sum up where the time goes.
+
+"""
+
+__copyright__ = "Copyright (C) 2020 Nordetect"
+
+import json
+import os
+from contextlib import contextmanager
+from time import time, monotonic
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+Span = Tuple[str, float, float]
+"""A timed stage as (name, start, seconds), start relative to the run start."""
+
+Run = Dict[str, Any]
+"""A run as stored in the trace file."""
+
+
+class Trace():
+
+    """The spans recorded during one run."""
+
+    def __init__(self) -> None:
+        """Constructor."""
+        self.timestamp = time()
+        self.start = monotonic()
+        self.spans: List[Span] = []
+
+    def add(self, name: str, start: float, seconds: float) -> None:
+        """Add a span.
+
+        Parameters:
+            name: Name of the stage.
+            start: Monotonic time the stage started.
+            seconds: Time used by the stage.
+
+        """
+        self.spans.append((name, start - self.start, seconds))
+
+    def as_dict(self) -> Run:
+        """Get the run as a dict ready for json."""
+        return {
+            'timestamp': self.timestamp,
+            'total': monotonic() - self.start,
+            'spans': [{'name': name, 'start': start, 'seconds': seconds} for name, start, seconds in self.spans],
+            }
+
+
+_current: Optional[Trace] = None
+
+
+def start_run() -> Trace:
+    """Start recording spans for a new run.
+
+    Returns:
+        The trace of the run.
+
+    """
+    global _current
+    _current = Trace()
+    return _current
+
+
+def finish_run(filename: str, max_runs: int) -> Optional[Run]:
+    """Stop recording and store the run in the trace file.
+
+    The file is a JSON line per run. Only the last max_runs runs are kept.
+
+    Parameters:
+        filename: The trace file.
+        max_runs: Number of runs to keep in the file.
+    Returns:
+        The stored run or None if no run was active.
+
+    """
+    global _current
+    if _current is None:
+        return None
+    run = _current.as_dict()
+    _current = None
+    lines = []
+    if os.path.isfile(filename):
+        with open(filename) as fh:
+            lines = fh.readlines()
+    lines.append(json.dumps(run) + '\n')
+    lines = lines[-max_runs:]
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as fh:
+        fh.writelines(lines)
+    os.replace(tmp_filename, filename)
+    return run
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """Time the enclosed code as a stage of the active run.
+
+    Parameters:
+        name: Name of the stage.
+
+    """
+    trace = _current
+    start = monotonic()
+    try:
+        yield
+    finally:
+        if trace is not None:
+            trace.add(name, start, monotonic() - start)
+
+
+def add_span(name: str, seconds: float, start: Optional[float] = None) -> None:
+    """Add a stage timed elsewhere to the active run.
+
+    Parameters:
+        name: Name of the stage.
+        seconds: Time used by the stage.
+        start: Monotonic time the stage started. If None, it ended now.
+
+    """
+    if _current is not None:
+        if start is None:
+            start = monotonic() - seconds
+        _current.add(name, start, seconds)
+
+
+def read_runs(filename: str, last: Optional[int] = None) -> List[Run]:
+    """Read the runs stored in a trace file.
+
+    Parameters:
+        filename: The trace file.
+        last: Only read this many of the newest runs. All if None.
+    Returns:
+        The runs, oldest first. Lines that can not be read are skipped.
+
+    """
+    if not os.path.isfile(filename):
+        return []
+    with open(filename) as fh:
+        lines = fh.readlines()
+    if last is not None:
+        lines = lines[-last:] if last > 0 else []
+    runs = []
+    for line in lines:
+        try:
+            runs.append(json.loads(line))
+        except ValueError:
+            pass
+    return runs
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Get a percentile with linear interpolation like numpy.percentile.
+
+    Parameters:
+        values: The values. Must not be empty.
+        q: Percentile between 0 and 100.
+    Returns:
+        The percentile of the values.
+
+    """
+    ordered = sorted(values)
+    pos = (len(ordered) - 1) * q / 100.0
+    low = int(pos)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (pos - low)
+
+
+def stage_percentiles(runs: List[Run]) -> Dict[str, Dict[str, float]]:
+    """Sum up the time of each stage over a number of runs.
+
+    A stage timed more than once in a run, like a capture for every spot,
+    counts with the sum of its spans in that run.
+
+    Parameters:
+        runs: Runs as returned by read_runs.
+    Returns:
+        Dict with the stage names ('total' for the whole run) as keys and
+        dicts with the number of runs, p50 and p95 in seconds as values.
+
+    """
+    per_stage: Dict[str, List[float]] = {}
+    for run in runs:
+        per_run: Dict[str, float] = {}
+        for s in run.get('spans', []):
+            per_run[s['name']] = per_run.get(s['name'], 0.0) + s['seconds']
+        per_run['total'] = run.get('total', 0.0)
+        for name, seconds in per_run.items():
+            per_stage.setdefault(name, []).append(seconds)
+    return {name: {'runs': len(values),
+                   'p50': percentile(values, 50),
+                   'p95': percentile(values, 95)}
+            for name, values in per_stage.items()}